@@ -0,0 +1,282 @@
+import os
+import re
+import sys
+import gc
+import json
+import time
+import random
+import platform
+import threading
+import subprocess
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from util import pop_option, ClientWrapper, CallMetrics
+import generate_dependence
+from generate_tree import generate_tree, generate_fusion_edges
+from generate_gitmind import convert_tree_to_gitmind, transform_line, transform_mix_line
+
+os.makedirs("./data", exist_ok=True)
+
+def random_dag(edge_num, rnd):
+    node_num = max(2, edge_num // 2)
+    edges = [(rnd.randrange(idx), idx) for idx in range(1, node_num)]
+    while len(edges) < edge_num:
+        source = rnd.randrange(node_num - 1)
+        edges.append((source, rnd.randrange(source + 1, node_num)))
+    return edges
+
+def deep_chain(edge_num, rnd):
+    return [(idx, idx + 1) for idx in range(edge_num)]
+
+def wide_fan(edge_num, rnd):
+    hub_num = max(1, int(edge_num ** 0.5))
+    edges = [(0, hub) for hub in range(1, hub_num + 1)]
+    leaf = hub_num + 1
+    while len(edges) < edge_num:
+        edges.append((rnd.randint(1, hub_num), leaf))
+        leaf += 1
+    return edges
+
+def noisy_cyclic(edge_num, rnd, noise=0.1):
+    edges = random_dag(edge_num - int(edge_num * noise), rnd)
+    node_num = max(target for _, target in edges) + 1
+    while len(edges) < edge_num:
+        edges.append((rnd.randrange(node_num), rnd.randrange(node_num)))
+    return edges
+
+graph_shapes = {
+    "dag": random_dag,
+    "chain": deep_chain,
+    "fan": wide_fan,
+    "cyclic": noisy_cyclic
+}
+
+def make_dependencies(shape, edge_num, seed=0):
+    edges = graph_shapes[shape](edge_num, random.Random(seed))
+    return [{"source": f"node{source}", "target": f"node{target}"} for source, target in edges]
+
+def make_mix_edges(tree, edge_num, seed=0):
+    # splits the nodes of one tree in two halves and links them, which is all transform_mix_line looks at
+    rnd = random.Random(seed)
+    names = [node['text'] for node in tree['nodes']]
+    half = len(names) // 2
+    left_names, right_names = names[:half] or names, names[half:]
+    node_set_list = [set(left_names), set(right_names)]
+    total_node_id = {node['text']: node['id'] for node in tree['nodes']}
+    dependencies = []
+    for _ in range(edge_num):
+        left, right = rnd.choice(left_names), rnd.choice(right_names)
+        dependencies.append({"source": left, "target": right} if rnd.random() < 0.5 else {"source": right, "target": left})
+    return generate_fusion_edges(dependencies, node_set_list, total_node_id)
+
+def measure(func, *args, memory=True):
+    gc.collect()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    peak_mb = None
+    if memory:
+        # tracemalloc slows the call down, so memory is measured on a second run
+        del result
+        gc.collect()
+        tracemalloc.start()
+        result = func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak_mb = peak / 1024 / 1024
+    return result, seconds, peak_mb
+
+def run_graph_benchmarks(shape_list, size_list, memory=True):
+    results = []
+    for shape in shape_list:
+        for edge_num in size_list:
+            dependencies = make_dependencies(shape, edge_num)
+            stages = []
+            tree, seconds, peak_mb = measure(generate_tree, dependencies, memory=memory)
+            stages.append(("generate_tree", seconds, peak_mb))
+            _, seconds, peak_mb = measure(convert_tree_to_gitmind, tree, memory=memory)
+            stages.append(("convert_tree_to_gitmind", seconds, peak_mb))
+            _, seconds, peak_mb = measure(transform_line, tree, memory=memory)
+            stages.append(("transform_line", seconds, peak_mb))
+            mix_edges = make_mix_edges(tree, max(1, edge_num // 10))
+            _, seconds, peak_mb = measure(transform_mix_line, mix_edges, memory=memory)
+            stages.append(("transform_mix_line", seconds, peak_mb))
+            for stage, seconds, peak_mb in stages:
+                results.append({"stage": stage, "shape": shape, "edges": edge_num, "seconds": seconds, "peak_mb": peak_mb})
+                memory_text = f"{peak_mb:.1f}MB" if peak_mb is not None else "-"
+                print(f"{stage:<24} {shape:<7} {edge_num:>8} edges {seconds:>9.3f}s {memory_text:>10}")
+            del tree, dependencies
+    return results
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    edges_per_response = 20
+    request_num = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        with FakeOpenAIHandler.lock:
+            FakeOpenAIHandler.request_num += 1
+        time.sleep(self.latency)
+        user_content = body['messages'][-1]['content']
+        if '"pairs"' in user_content:
+            # candidate batches: confirm every other pair by id
+            pairs = json.loads(user_content[user_content.index("{"):user_content.rindex("}") + 1])['pairs']
+            edges = [{"source": source, "target": target} for source, target in pairs[::2]]
+        else:
+            # --use-ids prompts number the items and expect ids back, other prompts expect names
+            names = [int(idx) for idx in dict.fromkeys(re.findall(r'"id":\s*(\d+)', user_content))]
+            names = names or list(dict.fromkeys(re.findall(r'item\d+', user_content)))
+            edges = [{"source": names[idx], "target": names[idx + 1]} for idx in range(min(len(names) - 1, self.edges_per_response))]
+        content = f"```json\n{json.dumps(edges)}\n```"
+        prompt_tokens = sum(len(message['content']) for message in body['messages']) // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 4,
+                 "total_tokens": prompt_tokens + len(content) // 4}
+        if body.get('stream'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            for idx in range(0, len(content), 64):
+                chunk = {"id": "fake", "object": "chat.completion.chunk", "created": 0, "model": body.get('model', 'fake'),
+                         "choices": [{"index": 0, "delta": {"content": content[idx:idx + 64]}, "finish_reason": None}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+            if (body.get('stream_options') or {}).get('include_usage'):
+                # like the real APIs, usage is only streamed when the request asks for it
+                chunk = {"id": "fake", "object": "chat.completion.chunk", "created": 0, "model": body.get('model', 'fake'),
+                         "choices": [], "usage": usage}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+            self.wfile.write(b"data: [DONE]\n\n")
+            return
+        payload = json.dumps({
+            "id": "fake", "object": "chat.completion", "created": 0, "model": body.get('model', 'fake'),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+def start_fake_server(latency=0.0):
+    FakeOpenAIHandler.latency = latency
+    FakeOpenAIHandler.request_num = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run_llm_benchmark(item_num, chunk_size=100, latency=0.2, workers=4, stream=False):
+    server = start_fake_server(latency)
+    config_list = [{"api_key": "fake", "base_url": f"http://127.0.0.1:{server.server_address[1]}/v1", "model": "fake"}]
+    original_client = generate_dependence.client
+    metrics = CallMetrics()
+    generate_dependence.client = ClientWrapper(config_list, workers_per_api=workers, metrics=metrics)
+    sink = None
+    if stream:
+        open("./data/benchmark_stream.jsonl", 'w').close()
+        sink = generate_dependence.EdgeSink("./data/benchmark_stream.jsonl")
+    rnd = random.Random(0)
+    topic_words = [f"topic{idx}" for idx in range(max(1, item_num // 20))]
+    items = [{"name": f"item{idx}", "description": f"synthetic item about {rnd.choice(topic_words)} and {rnd.choice(topic_words)}"}
+             for idx in range(item_num)]
+    try:
+        start = time.perf_counter()
+        edges = generate_dependence.generate_dependece_graph_chunked(items, chunk_size, sink)
+        seconds = time.perf_counter() - start
+    finally:
+        generate_dependence.client = original_client
+        server.shutdown()
+        server.server_close()
+    result = {"stage": "generate_dependece_graph_chunked", "items": item_num, "chunk_size": chunk_size, "latency": latency,
+              "workers": workers, "stream": stream, "candidates": generate_dependence.prompt_config["candidates"], "requests": FakeOpenAIHandler.request_num, "edges_found": len(edges),
+              "seconds": seconds, "calls": metrics.summary()["backends"]}
+    print(f"{'llm stage':<24} {item_num:>8} items {FakeOpenAIHandler.request_num:>5} requests {seconds:>9.3f}s")
+    print(metrics.format_summary())
+    return result
+
+def run_gather_benchmark(request_num, latency=0.2, workers=4, rounds=2):
+    # every gather() call runs its own event loop, so more than one round also checks that nothing is tied to the first loop
+    server = start_fake_server(latency)
+    config_list = [{"api_key": "fake", "base_url": f"http://127.0.0.1:{server.server_address[1]}/v1", "model": "fake"}]
+    fake_client = ClientWrapper(config_list, workers_per_api=workers, metrics=CallMetrics())
+    results = []
+    try:
+        for round_idx in range(rounds):
+            kwargs_list = [{"model": "fake", "messages": [{"role": "user", "content": f"item{idx} item{idx + 1} round {round_idx}"}]}
+                           for idx in range(request_num)]
+            start = time.perf_counter()
+            fake_client.chat.completions.gather(kwargs_list)
+            seconds = time.perf_counter() - start
+            results.append({"stage": f"gather_{round_idx + 1}", "items": request_num, "latency": latency,
+                            "workers": workers, "seconds": seconds})
+            print(f"{'gather_' + str(round_idx + 1):<24} {request_num:>8} requests {seconds:>9.3f}s")
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(results, previous_path):
+    with open(previous_path, encoding='utf-8') as f:
+        previous = json.load(f)
+    previous_seconds = {(item['stage'], item.get('shape'), item.get('edges', item.get('items'))): item['seconds']
+                        for item in previous['results']}
+    print(f"compared with {previous.get('commit')} ({previous_path})")
+    for item in results:
+        key = (item['stage'], item.get('shape'), item.get('edges', item.get('items')))
+        if key not in previous_seconds or previous_seconds[key] == 0:
+            continue
+        ratio = item['seconds'] / previous_seconds[key]
+        print(f"{item['stage']:<32} {str(key[1] or ''):<7} {key[2]:>8} {ratio:>6.2f}x")
+
+
+def main():
+    size_list = [int(size) for size in pop_option(sys.argv, "--sizes", "100,1000,10000,100000").split(",")]
+    shape_list = pop_option(sys.argv, "--shapes", ",".join(graph_shapes)).split(",")
+    for shape in shape_list:
+        if shape not in graph_shapes:
+            print(f"error: unknown graph shape {shape}, choose from {', '.join(graph_shapes)}")
+            return
+    llm_items = int(pop_option(sys.argv, "--llm-items", 1000))
+    chunk_size = int(pop_option(sys.argv, "--chunk-size", 100))
+    latency = float(pop_option(sys.argv, "--latency", 0.2))
+    workers = int(pop_option(sys.argv, "--workers", 4))
+    compare_path = pop_option(sys.argv, "--compare")
+    generate_dependence.pop_prompt_options(sys.argv)
+    output_path = pop_option(sys.argv, "--output", f"./data/benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    memory = "--no-memory" not in sys.argv
+    if not memory:
+        sys.argv.remove("--no-memory")
+    stream = "--stream" in sys.argv
+    if stream:
+        sys.argv.remove("--stream")
+
+    results = run_graph_benchmarks(shape_list, size_list, memory)
+    if llm_items > 0:
+        results.append(run_llm_benchmark(llm_items, chunk_size, latency, workers, stream))
+        results.extend(run_gather_benchmark(max(1, llm_items // chunk_size if chunk_size > 0 else 1), latency, workers))
+
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            "commit": current_commit(),
+            "python": platform.python_version(),
+            "time": time.strftime('%Y-%m-%d %H:%M:%S'),
+            "results": results
+        }, f, indent=4)
+    print(f"saved {output_path}")
+    if compare_path is not None:
+        compare_results(results, compare_path)
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,14 @@
 import os
+import re
 import json
 import sys
-from util import client, extract_from_code_block, extract_json_from_str
+import math
+import hashlib
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from name_index import NameIndex
+from util import client, call_metrics, extract_from_code_block, extract_json_from_str, repair_json, JobManifest, pop_option
 
 dependence_prompt = '''Please read input json and follow these instructions:
 1. Genertate the dependence between the elements of input json, where the "target" element should be more specific or a refined version of the "source" element.
@@ -29,95 +36,614 @@ fusion_prompt = '''Please read input two json, and follow these instructions:
 
 '''
 
+dependence_id_prompt = '''Please read input json and follow these instructions:
+1. Each element of input json has an integer "id". Genertate the dependence between the elements, where the "target" element should be more specific or a refined version of the "source" element.
+2. Refer to elements by their "id" only. Output should be in in the format of "```json\n<output>", where "<output>" is a placeholder. An output example is as follows:
 
-def generate_dependece_graph(json_data):
-    global dependence_prompt, client
+```json
+[
+    {"source": 0, "target": 3},
+    {"source": 5, "target": 2}
+]
+```
+'''
+
+fusion_id_prompt = '''Please read input two json, and follow these instructions:
+1. Each element has an integer "id". Genertate the dependence between the elements of the first one and those of the second one, where "source" element should be in the first json and the "target" element should be in the second json.
+2. Refer to elements by their "id" only. Output should be in in the format of "```json\n<output>", where "<output>" is a placeholder. An output example is as follows:
+
+```json
+[
+    {"source": <id_in_first_json>, "target": <id_in_second_json>}
+]
+```
+'''
+
+candidate_prompt = '''Please read input json and follow these instructions:
+1. "items" lists elements with an integer "id" and "pairs" lists candidate pairs of ids. For every pair, decide whether one element is more general and the other is more specific or a refined version of it.
+2. Keep only the pairs related this way, with "source" the general element and "target" the specific one. Refer to elements by their "id" only. Output should be in in the format of "```json\n<output>", where "<output>" is a placeholder. An output example is as follows:
+
+```json
+[
+    {"source": 0, "target": 3},
+    {"source": 5, "target": 2}
+]
+```
+'''
+
+fusion_candidate_prompt = '''Please read input json and follow these instructions:
+1. "items" lists elements with an integer "id" and "pairs" lists candidate pairs of ids as [source, target], where the source element comes from a first collection and the target element from a second one. For every pair, decide whether the target depends on the source.
+2. Keep only the pairs where the dependence holds. Refer to elements by their "id" only. Output should be in in the format of "```json\n<output>", where "<output>" is a placeholder. An output example is as follows:
+
+```json
+[
+    {"source": 0, "target": 3}
+]
+```
+'''
+
+prompt_config = {
+    "compact": False,
+    "max_text_chars": None,
+    "use_ids": False,
+    "token_budget": None,
+    "candidates": None
+}
+
+
+class EdgeStreamParser:
+    def __init__(self):
+        self.buffer = []
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+
+    def feed(self, text):
+        edges = []
+        for char in text:
+            if self.depth > 0:
+                self.buffer.append(char)
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = self.depth > 0
+            elif char == "{":
+                if self.depth == 0:
+                    self.buffer = [char]
+                self.depth += 1
+            elif char == "}" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    edge = self.parse_edge("".join(self.buffer))
+                    if edge is not None:
+                        edges.append(edge)
+        return edges
+
+    @staticmethod
+    def parse_edge(text):
+        try:
+            edge = json.loads(text)
+        except Exception:
+            try:
+                edge = json.loads(repair_json(text))
+            except Exception:
+                return None
+        if not isinstance(edge, dict) or 'source' not in edge or 'target' not in edge:
+            return None
+        return {"source": edge['source'], "target": edge['target']}
+
+class EdgeSink:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def write(self, edge):
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(edge, ensure_ascii=False) + "\n")
+
+class PartialEdges(list):
+    pass
+
+def estimate_tokens(text):
+    non_ascii_num = sum(1 for char in text if ord(char) > 127)
+    return (len(text) - non_ascii_num) // 4 + non_ascii_num + 1
+
+def compact_item(item, max_text_chars=None):
+    if max_text_chars is None:
+        return item
+    compacted = {}
+    for k, v in item.items():
+        if k != 'name' and isinstance(v, str) and len(v) > max_text_chars:
+            v = v[:max_text_chars] + "..."
+        compacted[k] = v
+    return compacted
+
+def encode_items(json_data):
+    global prompt_config
+    items = [compact_item(item, prompt_config["max_text_chars"]) for item in json_data]
+    if prompt_config["use_ids"]:
+        items = [{"id": idx, **item} for idx, item in enumerate(items)]
+    if prompt_config["compact"]:
+        return json.dumps(items, ensure_ascii=False, separators=(",", ":"))
+    return json.dumps(items)
+
+def pack_chunks(lst, chunk_size, budget_share=1.0):
+    global prompt_config
+    if prompt_config["token_budget"] is None:
+        return split_chunks(lst, chunk_size)
+    token_budget = prompt_config["token_budget"] * budget_share
+    chunks = []
+    chunk = []
+    chunk_tokens = 0
+    for item in lst:
+        item_tokens = estimate_tokens(encode_items([item]))
+        full = chunk_size > 0 and len(chunk) >= chunk_size
+        if chunk and (full or chunk_tokens + item_tokens > token_budget):
+            chunks.append(chunk)
+            chunk = []
+            chunk_tokens = 0
+        chunk.append(item)
+        chunk_tokens += item_tokens
+    if chunk or not chunks:
+        chunks.append(chunk)
+    return chunks
+
+def first_chunk(lst, chunk_size, budget_share=1.0):
+    chunks = pack_chunks(lst, chunk_size, budget_share)
+    return chunks[0] if chunks else []
+
+def decode_edge(edge, source_items, target_items):
+    try:
+        source_item = source_items[int(edge['source'])]
+        target_item = target_items[int(edge['target'])]
+    except (ValueError, TypeError, IndexError, KeyError):
+        return None
+    return {"source": item_key(source_item), "target": item_key(target_item)}
+
+def request_dependence(messages, sink=None, decode=None):
+    global client
+    if sink is None:
+        completion = client.chat.completions.create(
+            model="qwen-plus",
+            messages=messages,
+            stream=False,
+            temperature=0.01
+        )
+        result = completion.choices[0].message.content
+        result_json_list = extract_from_code_block(result)
+        if len(result_json_list) > 0:
+            result_json_str = result_json_list[0]
+            result_json = extract_json_from_str(result_json_str)
+            if decode is not None and isinstance(result_json, list):
+                result_json = [decode(edge) for edge in result_json if isinstance(edge, dict)]
+                result_json = [edge for edge in result_json if edge is not None]
+            return result_json
+        else:
+            return {}
+
+    parser = EdgeStreamParser()
+    edges = []
+    # errors before the stream opens are not partial results and propagate like in the non-streaming branch
     completion = client.chat.completions.create(
         model="qwen-plus",
-        messages=[
-            {'role': 'system', 'content': dependence_prompt},
-            {'role': 'user', 'content': f'```input json\n{json.dumps(json_data)}```'}
-        ],
-        stream=False,
+        messages=messages,
+        stream=True,
         temperature=0.01
     )
-    result = completion.choices[0].message.content
-    result_json_list = extract_from_code_block(result)
-    if len(result_json_list) > 0:
-        result_json_str = result_json_list[0]
-        result_json = extract_json_from_str(result_json_str)
-    else:
-        return {}
+    try:
+        for chunk in completion:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            for edge in parser.feed(chunk.choices[0].delta.content):
+                if decode is not None:
+                    edge = decode(edge)
+                    if edge is None:
+                        continue
+                edges.append(edge)
+                sink.write(edge)
+    except Exception as e:
+        print(f"stream interrupted after {len(edges)} edges: {e}")
+        return PartialEdges(edges)
+    return edges
+
+def generate_dependece_graph(json_data, sink=None):
+    global dependence_prompt, dependence_id_prompt, prompt_config
+    use_ids = prompt_config["use_ids"]
+    messages = [
+        {'role': 'system', 'content': dependence_id_prompt if use_ids else dependence_prompt},
+        {'role': 'user', 'content': f'```input json\n{encode_items(json_data)}```'}
+    ]
+    decode = (lambda edge: decode_edge(edge, json_data, json_data)) if use_ids else None
+    return request_dependence(messages, sink, decode)
+
+def split_chunks(lst, chunk_size):
+    if chunk_size <= 0:
+        return [lst]
+    return [lst[i:i+chunk_size] for i in range(0, len(lst), chunk_size)]
+
+def merge_dependence(result_list):
+    merged = []
+    visited_edges = set()
+    for result in result_list:
+        if not isinstance(result, list):
+            continue
+        for edge in result:
+            if not isinstance(edge, dict) or 'source' not in edge or 'target' not in edge:
+                continue
+            key = (edge['source'], edge['target'])
+            if key in visited_edges:
+                continue
+            visited_edges.add(key)
+            merged.append({"source": edge['source'], "target": edge['target']})
+    return merged
+
+def map_parallel(func, items, max_workers):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(func, item) for item in items]
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    if errors:
+        raise errors[0]
+    return [future.result() for future in futures]
+
+def run_checkpointed(manifest, payload, func):
+    if manifest is None:
+        return func()
+    task_id = JobManifest.make_task_id(*payload)
+    entry = manifest.get(task_id)
+    if entry is not None and entry['status'] == "done":
+        return entry['result']
+    manifest.record(task_id, "running", kind=payload[0])
+    try:
+        result = func()
+    except Exception as e:
+        manifest.record(task_id, "failed", kind=payload[0], error=str(e))
+        raise
+    status = "partial" if isinstance(result, PartialEdges) else "done"
+    manifest.record(task_id, status, result=result, kind=payload[0])
+    return result
+
+def generate_dependece_graph_chunked(json_data, chunk_size=100, sink=None, manifest=None):
+    global client, dependence_prompt, prompt_config
+    if prompt_config["candidates"]:
+        return generate_dependece_candidates(json_data, None, chunk_size, sink, manifest)
+    chunks = [chunk for chunk in pack_chunks(json_data, chunk_size) if chunk]
+    if len(chunks) == 0:
+        return []
+    def run_chunk(chunk):
+        return run_checkpointed(manifest, ("graph", dependence_prompt, chunk), lambda: generate_dependece_graph(chunk, sink))
+    if len(chunks) == 1:
+        return merge_dependence([run_chunk(chunks[0])])
+    result_list = map_parallel(run_chunk, chunks, min(client.max_workers, len(chunks)))
+    return merge_dependence(result_list)
     
-def generate_dependece_fusion(json_data_1, json_data_2):
-    global fusion_prompt, client
-    completion = client.chat.completions.create(
-        model="qwen-plus",
-        messages=[
-            {'role': 'system', 'content': fusion_prompt},
-            {'role': 'user', 'content': f'```first json\n{json.dumps(json_data_1)}```\n\n```second json\n{json.dumps(json_data_2)}```'}
-        ],
-        stream=False,
-        temperature=0.01
-    )
-    result = completion.choices[0].message.content
-    result_json_list = extract_from_code_block(result)
-    if len(result_json_list) > 0:
-        result_json_str = result_json_list[0]
-        result_json = extract_json_from_str(result_json_str)
-        return result_json
-    else:
-        return {}
+def generate_dependece_fusion(json_data_1, json_data_2, sink=None):
+    global fusion_prompt, fusion_id_prompt, prompt_config
+    use_ids = prompt_config["use_ids"]
+    messages = [
+        {'role': 'system', 'content': fusion_id_prompt if use_ids else fusion_prompt},
+        {'role': 'user', 'content': f'```first json\n{encode_items(json_data_1)}```\n\n```second json\n{encode_items(json_data_2)}```'}
+    ]
+    decode = (lambda edge: decode_edge(edge, json_data_1, json_data_2)) if use_ids else None
+    return request_dependence(messages, sink, decode)
     
+def tokenize_item(item):
+    tokens = set()
+    for value in item.values():
+        values = value if isinstance(value, list) else [value]
+        for v in values:
+            if isinstance(v, str):
+                tokens.update(t for t in re.findall(r"[a-z0-9]+", v.lower()) if len(t) > 2)
+    return tokens
+
+def compute_chunk_tokens(chunks):
+    return [set().union(*[tokenize_item(item) for item in chunk]) if chunk else set() for chunk in chunks]
+
+def score_tiles(chunk_tokens_1, chunk_tokens_2):
+    doc_freq = {}
+    for tokens in chunk_tokens_1 + chunk_tokens_2:
+        for token in tokens:
+            doc_freq[token] = doc_freq.get(token, 0) + 1
+    doc_num = len(chunk_tokens_1) + len(chunk_tokens_2)
+    idf = {token: math.log(1 + doc_num / freq) for token, freq in doc_freq.items()}
+    scores = {}
+    for i, tokens_1 in enumerate(chunk_tokens_1):
+        for j, tokens_2 in enumerate(chunk_tokens_2):
+            scores[(i, j)] = sum(idf[token] for token in tokens_1 & tokens_2)
+    return scores
+
+def generate_dependece_fusion_tiled(json_data_1, json_data_2, chunk_size=100, min_score=None, sink=None, manifest=None):
+    global client, fusion_prompt, prompt_config
+    if prompt_config["candidates"]:
+        return generate_dependece_candidates(json_data_1, json_data_2, chunk_size, sink, manifest)
+    chunks_1 = [chunk for chunk in pack_chunks(json_data_1, chunk_size, 0.5) if chunk]
+    chunks_2 = [chunk for chunk in pack_chunks(json_data_2, chunk_size, 0.5) if chunk]
+    tiles = [(i, j) for i in range(len(chunks_1)) for j in range(len(chunks_2))]
+    if min_score is not None:
+        scores = score_tiles(compute_chunk_tokens(chunks_1), compute_chunk_tokens(chunks_2))
+        kept_tiles = [tile for tile in tiles if scores[tile] >= min_score]
+        print(f"pruned {len(tiles) - len(kept_tiles)} of {len(tiles)} fusion tiles")
+        tiles = kept_tiles
+    if len(tiles) == 0:
+        return []
+    def run_tile(tile):
+        chunk_1, chunk_2 = chunks_1[tile[0]], chunks_2[tile[1]]
+        return run_checkpointed(manifest, ("fusion", fusion_prompt, chunk_1, chunk_2),
+                                lambda: generate_dependece_fusion(chunk_1, chunk_2, sink))
+    result_list = map_parallel(run_tile, tiles, min(client.max_workers, len(tiles)))
+    return merge_dependence(result_list)
+    
+def find_candidate_pairs(items_1, items_2=None, limit=5, max_posting=200):
+    # inverted index over item tokens; tokens shared by more than max_posting items are too common to tell
+    # anything apart and are skipped, which keeps the work linear in the number of items
+    same = items_2 is None
+    tokens_1 = [tokenize_item(item) for item in items_1]
+    tokens_2 = tokens_1 if same else [tokenize_item(item) for item in items_2]
+    index = {}
+    for idx, tokens in enumerate(tokens_2):
+        for token in tokens:
+            index.setdefault(token, []).append(idx)
+    doc_num = len(tokens_2)
+    idf = {token: math.log(1 + doc_num / len(posting)) for token, posting in index.items() if len(posting) <= max_posting}
+    pairs = []
+    visited_pairs = set()
+    for idx_1, tokens in enumerate(tokens_1):
+        scores = {}
+        for token in tokens:
+            if token not in idf:
+                continue
+            for idx_2 in index[token]:
+                scores[idx_2] = scores.get(idx_2, 0.0) + idf[token]
+        if same:
+            scores.pop(idx_1, None)
+        for idx_2 in heapq.nlargest(limit, scores, key=lambda idx: (scores[idx], -idx)):
+            pair = (min(idx_1, idx_2), max(idx_1, idx_2)) if same else (idx_1, idx_2)
+            if pair not in visited_pairs:
+                visited_pairs.add(pair)
+                pairs.append(pair)
+    return pairs
+
+def pack_candidate_batches(pairs, chunk_size, ref_item):
+    # groups pairs of item refs into batches of at most chunk_size distinct items (and the token budget)
+    global prompt_config
+    token_budget = prompt_config["token_budget"]
+    batches = []
+    refs = {}
+    local_pairs = []
+    batch_tokens = 0
+    ref_tokens = lambda ref_list: sum(estimate_tokens(encode_items([ref_item(ref)])) for ref in ref_list) if token_budget else 0
+    for pair in pairs:
+        new_refs = [ref for ref in dict.fromkeys(pair) if ref not in refs]
+        full = chunk_size > 0 and len(refs) + len(new_refs) > chunk_size
+        if local_pairs and (full or (token_budget and batch_tokens + ref_tokens(new_refs) > token_budget)):
+            batches.append((list(refs), local_pairs))
+            refs = {}
+            local_pairs = []
+            batch_tokens = 0
+            new_refs = list(dict.fromkeys(pair))
+        for ref in new_refs:
+            refs[ref] = len(refs)
+        batch_tokens += ref_tokens(new_refs)
+        local_pairs.append((refs[pair[0]], refs[pair[1]]))
+    if local_pairs:
+        batches.append((list(refs), local_pairs))
+    return batches
+
+def encode_candidates(items, pairs):
+    global prompt_config
+    items = [{"id": idx, **compact_item(item, prompt_config["max_text_chars"])} for idx, item in enumerate(items)]
+    payload = {"items": items, "pairs": [list(pair) for pair in pairs]}
+    if prompt_config["compact"]:
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    return json.dumps(payload)
+
+def verify_candidates(items, pairs, directed=False, sink=None):
+    global candidate_prompt, fusion_candidate_prompt
+    messages = [
+        {'role': 'system', 'content': fusion_candidate_prompt if directed else candidate_prompt},
+        {'role': 'user', 'content': f'```input json\n{encode_candidates(items, pairs)}```'}
+    ]
+    allowed_pairs = set(pairs) if directed else set(pairs) | {(target, source) for source, target in pairs}
+    def decode(edge):
+        try:
+            pair = (int(edge['source']), int(edge['target']))
+        except (ValueError, TypeError, KeyError):
+            return None
+        if pair not in allowed_pairs:
+            return None
+        return {"source": item_key(items[pair[0]]), "target": item_key(items[pair[1]])}
+    return request_dependence(messages, sink, decode)
+
+def generate_dependece_candidates(json_data_1, json_data_2=None, chunk_size=100, sink=None, manifest=None):
+    global client, prompt_config
+    directed = json_data_2 is not None
+    data_list = [json_data_1, json_data_2] if directed else [json_data_1]
+    pairs = find_candidate_pairs(json_data_1, json_data_2, prompt_config["candidates"])
+    pairs = [((0, idx_1), (1 if directed else 0, idx_2)) for idx_1, idx_2 in pairs]
+    ref_item = lambda ref: data_list[ref[0]][ref[1]]
+    batches = [([ref_item(ref) for ref in refs], local_pairs)
+               for refs, local_pairs in pack_candidate_batches(pairs, chunk_size, ref_item)]
+    print(f"{len(pairs)} candidate pairs in {len(batches)} batches")
+    if len(batches) == 0:
+        return []
+    def run_candidates(batch):
+        items, local_pairs = batch
+        return run_checkpointed(manifest, ("candidates", directed, items, local_pairs),
+                                lambda: verify_candidates(items, local_pairs, directed, sink))
+    result_list = map_parallel(run_candidates, batches, min(client.max_workers, len(batches)))
+    return merge_dependence(result_list)
+
+def item_key(item):
+    if 'name' in item:
+        return item['name']
+    return json.dumps(item, ensure_ascii=False, sort_keys=True)
+
+def hash_item(item):
+    return hashlib.sha256(json.dumps(item, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+def snapshot_items(cleaned_data):
+    return {item_key(item): hash_item(item) for item in cleaned_data}
+
+def diff_snapshot(old_snapshot, cleaned_data):
+    new_snapshot = snapshot_items(cleaned_data)
+    affected_items = [item for item in cleaned_data if old_snapshot.get(item_key(item)) != hash_item(item)]
+    stale_keys = {key for key, item_hash in old_snapshot.items() if new_snapshot.get(key) != item_hash}
+    return affected_items, stale_keys
+
+def select_neighbourhood(items, candidates, candidate_tokens, limit, neighbour_keys=()):
+    neighbour_keys = set(neighbour_keys)
+    tokens = set().union(*[tokenize_item(item) for item in items]) if items else set()
+    item_keys = {item_key(item) for item in items}
+    doc_freq = {}
+    for candidate_token in candidate_tokens:
+        for token in candidate_token & tokens:
+            doc_freq[token] = doc_freq.get(token, 0) + 1
+    scored = []
+    for idx, (candidate, candidate_token) in enumerate(zip(candidates, candidate_tokens)):
+        key = item_key(candidate)
+        if key in item_keys:
+            continue
+        score = sum(math.log(1 + len(candidates) / doc_freq[token]) for token in candidate_token & tokens)
+        if key in neighbour_keys:
+            score += float("inf")
+        if score > 0:
+            scored.append((-score, idx))
+    scored.sort()
+    if limit > 0:
+        scored = scored[:limit]
+    # a limit of 0 keeps every related candidate, the same way chunk_size 0 keeps all items in one chunk
+    return [candidates[idx] for _, idx in scored]
+
+def edge_neighbour_keys(edges, keys):
+    neighbour_keys = set()
+    for edge in edges:
+        if edge['source'] in keys:
+            neighbour_keys.add(edge['target'])
+        if edge['target'] in keys:
+            neighbour_keys.add(edge['source'])
+    return neighbour_keys
+
+def update_dependence_graph(cleaned_data, old_snapshot, old_edges, chunk_size=100, sink=None, manifest=None):
+    global client, dependence_prompt
+    affected_items, stale_keys = diff_snapshot(old_snapshot, cleaned_data)
+    edges = [edge for edge in old_edges if edge['source'] not in stale_keys and edge['target'] not in stale_keys]
+    print(f"{len(affected_items)} new or changed items, {len(stale_keys)} stale items")
+    if len(affected_items) == 0:
+        return merge_dependence([edges])
+    affected_keys = {item_key(item) for item in affected_items}
+    unchanged_items = [item for item in cleaned_data if item_key(item) not in affected_keys]
+    unchanged_tokens = [tokenize_item(item) for item in unchanged_items]
+    def run_chunk(chunk):
+        neighbour_keys = edge_neighbour_keys(old_edges, {item_key(item) for item in chunk})
+        neighbourhood = select_neighbourhood(chunk, unchanged_items, unchanged_tokens, chunk_size, neighbour_keys)
+        request_items = chunk + first_chunk(neighbourhood, chunk_size, 0.5)
+        if len(request_items) < 2:
+            # a lone item with nothing related cannot have edges
+            return []
+        return run_checkpointed(manifest, ("graph", dependence_prompt, request_items),
+                                lambda: generate_dependece_graph(request_items, sink))
+    chunks = pack_chunks(affected_items, chunk_size, 0.5)
+    result_list = map_parallel(run_chunk, chunks, min(client.max_workers, len(chunks)))
+    return merge_dependence([edges] + result_list)
+
+def update_dependence_fusion(cleaned_data_1, cleaned_data_2, old_snapshot_1, old_snapshot_2, old_edges,
+                             chunk_size=100, sink=None, manifest=None):
+    global client, fusion_prompt
+    affected_items_1, stale_keys_1 = diff_snapshot(old_snapshot_1, cleaned_data_1)
+    affected_items_2, stale_keys_2 = diff_snapshot(old_snapshot_2, cleaned_data_2)
+    edges = [edge for edge in old_edges if edge['source'] not in stale_keys_1 and edge['target'] not in stale_keys_2]
+    print(f"{len(affected_items_1)} + {len(affected_items_2)} new or changed items for fusion")
+    affected_keys_1 = {item_key(item) for item in affected_items_1}
+    unchanged_items_1 = [item for item in cleaned_data_1 if item_key(item) not in affected_keys_1]
+    unchanged_tokens_1 = [tokenize_item(item) for item in unchanged_items_1]
+    tokens_2 = [tokenize_item(item) for item in cleaned_data_2]
+    tiles = []
+    for chunk in pack_chunks(affected_items_1, chunk_size, 0.5):
+        if chunk:
+            neighbourhood = select_neighbourhood(chunk, cleaned_data_2, tokens_2, chunk_size)
+            tiles.append((chunk, first_chunk(neighbourhood, chunk_size, 0.5)))
+    for chunk in pack_chunks(affected_items_2, chunk_size, 0.5):
+        if chunk:
+            neighbourhood = select_neighbourhood(chunk, unchanged_items_1, unchanged_tokens_1, chunk_size)
+            tiles.append((first_chunk(neighbourhood, chunk_size, 0.5), chunk))
+    tiles = [(chunk_1, chunk_2) for chunk_1, chunk_2 in tiles if chunk_1 and chunk_2]
+    if len(tiles) == 0:
+        return merge_dependence([edges])
+    def run_tile(tile):
+        chunk_1, chunk_2 = tile
+        return run_checkpointed(manifest, ("fusion", fusion_prompt, chunk_1, chunk_2),
+                                lambda: generate_dependece_fusion(chunk_1, chunk_2, sink))
+    result_list = map_parallel(run_tile, tiles, min(client.max_workers, len(tiles)))
+    return merge_dependence([edges] + result_list)
+
 def find_index(lst, target):
     for i, value in enumerate(lst):
         if value == target:
             return i
     return -1
     
-def main():
-    if len(sys.argv) < 2:
+def pop_prompt_options(argv):
+    global prompt_config
+    token_budget = pop_option(argv, "--token-budget")
+    prompt_config["token_budget"] = int(token_budget) if token_budget is not None else None
+    max_text_chars = pop_option(argv, "--max-text-chars")
+    prompt_config["max_text_chars"] = int(max_text_chars) if max_text_chars is not None else None
+    candidates = pop_option(argv, "--candidates")
+    prompt_config["candidates"] = int(candidates) if candidates is not None else None
+    for flag, key in (("--compact", "compact"), ("--use-ids", "use_ids")):
+        prompt_config[key] = flag in argv
+        if prompt_config[key]:
+            argv.remove(flag)
+
+def parse_args(argv):
+    if len(argv) < 2:
         print("please provide at least one parameter as the json path")
-        return
+        return None
     
-    json_arg_idx = [idx for idx, arg in enumerate(sys.argv) if arg.endswith(".json")]
+    json_arg_idx = [idx for idx, arg in enumerate(argv) if arg.endswith(".json")]
 
     if len(json_arg_idx) == 0:
         print("no json path in args")
-        return
+        return None
     if len(json_arg_idx) > 2:
         print(f"{len(json_arg_idx)} json paths in arg, only 1 and 2 is accepted.")
-        return
+        return None
     
     split_signal = "+"
 
     json_path_list =[]
 
-    file_path_1 = sys.argv[json_arg_idx[0]]
+    file_path_1 = argv[json_arg_idx[0]]
     if not os.path.exists(file_path_1):
         print(f"error: file {file_path_1} doesn't exist")
-        return
+        return None
     
     json_path_list.append(file_path_1)
     
     key_list_list = []
+    mix_key_list_list = []
     if len(json_arg_idx) == 1:
-        key_list_1 = sys.argv[json_arg_idx[0]+1:]
+        key_list_1 = argv[json_arg_idx[0]+1:]
         key_list_1 = ["name", "description"] if len(key_list_1) == 0 else key_list_1
         key_list_list.append(key_list_1)
     else:
-        file_path_2 = sys.argv[json_arg_idx[1]]
+        file_path_2 = argv[json_arg_idx[1]]
         if not os.path.exists(file_path_2):
             print(f"error: file {file_path_2} doesn't exist")
-            return
+            return None
         json_path_list.append(file_path_2)
-        key_list_1 = sys.argv[json_arg_idx[0]+1:json_arg_idx[1]]
+        key_list_1 = argv[json_arg_idx[0]+1:json_arg_idx[1]]
         key_list_1 = ["name", "description"] if len(key_list_1) == 0 else key_list_1
         key_list_list.append(key_list_1)
-        key_list_2 = sys.argv[json_arg_idx[1]+1:]
+        key_list_2 = argv[json_arg_idx[1]+1:]
         key_list_2 = ['name', "description"] if len(key_list_2) == 0 else key_list_2
         key_list_list.append(key_list_2)
-        mix_key_arg_list = sys.argv[1:json_arg_idx[0]]
+        mix_key_arg_list = argv[1:json_arg_idx[0]]
         if len(mix_key_arg_list) == 0:
             mix_key_list_1 = ["name", "latent_techniques"]
             mix_key_list_2 = ['name', "targeted_tasks"]
@@ -130,47 +656,164 @@ def main():
             mix_key_list_1 = ["name", "latent_techniques"] if len(mix_key_list_1) == 0 else mix_key_list_1
             mix_key_list_2 = mix_key_arg_list[split_idx+1:]
             mix_key_list_2 = ['name', "targeted_tasks"] if len(mix_key_list_2) == 0 else mix_key_list_2
+        mix_key_list_list = [mix_key_list_1, mix_key_list_2]
+    return json_path_list, key_list_list, mix_key_list_list
 
-    data_list = []
-    for file_path, key_list in zip(json_path_list, key_list_list):
-        with open(file_path, encoding='utf-8') as f:
-            data = json.load(f)
-        data_list.append(data)
-        cleaned_data= []
-        for item in data:
-            cleaned_data.append({k: v for k, v in item.items() if k in key_list})
-    
-        result = generate_dependece_graph(cleaned_data)
-    
-        base_name = os.path.basename(file_path)
-        new_file_name = base_name.replace(".json", "_dependence.json")
-        save_path = os.path.join("./data/", new_file_name)
-    
-        with open(save_path, 'w', encoding='utf-8') as f:
-            json.dump(result, f, ensure_ascii=False, indent=4)
-    
-    if len(json_arg_idx) == 1:
-        return
+def clean_data(data, key_list):
+    return [{k: v for k, v in item.items() if k in key_list} for item in data]
 
-    cleaned_data_1 = []
-    for item in data_list[0]:
-        cleaned_data_1.append({k: v for k, v in item.items() if k in mix_key_list_1})
+def stream_sink_path_list(json_path_list, output_dir="./data/", reset=True):
+    name_list = [dependence_file_name(file_path) for file_path in json_path_list]
+    if len(json_path_list) > 1:
+        name_list.append(fusion_file_name(json_path_list))
+    path_list = [os.path.join(output_dir, name.replace(".json", ".jsonl")) for name in name_list]
+    if reset:
+        for path in path_list:
+            open(path, 'w').close()
+    return path_list
 
-    cleaned_data_2 = []
-    for item in data_list[1]:
-        cleaned_data_2.append({k: v for k, v in item.items() if k in mix_key_list_2})
+def manifest_path(json_path_list, output_dir="./data/"):
+    return os.path.join(output_dir, fusion_file_name(json_path_list).replace("dependence.json", "manifest.jsonl"))
 
-    result_fusion = generate_dependece_fusion(cleaned_data_1, cleaned_data_2)
+def dependence_file_name(file_path):
+    return os.path.basename(file_path).replace(".json", "_dependence.json")
 
-    fusion_save_path = "./data/"
+def fusion_file_name(json_path_list):
+    file_name = ""
     for file_path in json_path_list:
         base_name = os.path.basename(file_path).split(".")[0]
-        fusion_save_path += base_name+"_"
-    fusion_save_path = fusion_save_path + "dependence.json"
+        file_name += base_name+"_"
+    return file_name + "dependence.json"
+
+def snapshot_file_name(dependence_name):
+    return dependence_name.replace("dependence.json", "snapshot.json")
+
+def load_previous_run(json_path_list, output_dir="./data/"):
+    name_list = [dependence_file_name(file_path) for file_path in json_path_list]
+    if len(json_path_list) > 1:
+        name_list.append(fusion_file_name(json_path_list))
+    previous = []
+    for name in name_list:
+        dependence_path = os.path.join(output_dir, name)
+        snapshot_path = os.path.join(output_dir, snapshot_file_name(name))
+        if not os.path.exists(dependence_path) or not os.path.exists(snapshot_path):
+            previous.append(None)
+            continue
+        with open(dependence_path, encoding='utf-8') as f:
+            edges = json.load(f)
+        with open(snapshot_path, encoding='utf-8') as f:
+            snapshot = json.load(f)
+        previous.append((snapshot, edges if isinstance(edges, list) else []))
+    return previous
+
+def save_snapshots(json_path_list, data_list, key_list_list, mix_key_list_list=None, output_dir="./data/"):
+    for file_path, data, key_list in zip(json_path_list, data_list, key_list_list):
+        snapshot_path = os.path.join(output_dir, snapshot_file_name(dependence_file_name(file_path)))
+        with open(snapshot_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot_items(clean_data(data, key_list)), f, ensure_ascii=False)
+    if mix_key_list_list:
+        snapshot_path = os.path.join(output_dir, snapshot_file_name(fusion_file_name(json_path_list)))
+        snapshot = [snapshot_items(clean_data(data, key_list)) for data, key_list in zip(data_list, mix_key_list_list)]
+        with open(snapshot_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+
+def resolve_dependence(edges, source_items, target_items=None, label="edges"):
+    # snaps the names returned by the model to the input items; unresolved edges are kept as they are
+    source_index = NameIndex(item_key(item) for item in source_items)
+    target_index = source_index if target_items is None else NameIndex(item_key(item) for item in target_items)
+    resolved = []
+    for edge in edges:
+        source = source_index.resolve(edge['source'])
+        target = target_index.resolve(edge['target'])
+        edge = {"source": source if source is not None else edge['source'],
+                "target": target if target is not None else edge['target']}
+        if edge['source'] != edge['target']:
+            resolved.append(edge)
+    if target_items is None:
+        print(source_index.report(label))
+    else:
+        print(source_index.report(f"{label} sources"))
+        print(target_index.report(f"{label} targets"))
+    return merge_dependence([resolved])
+
+def run_dependence(data_list, key_list_list, mix_key_list_list=None, chunk_size=100, min_score=None, sink_path_list=None,
+                   manifest=None, previous=None):
+    sink_list = [EdgeSink(path) for path in sink_path_list] if sink_path_list else [None] * (len(data_list) + 1)
+    previous = previous or [None] * (len(data_list) + 1)
+    result_list = []
+    for data, key_list, sink, previous_run in zip(data_list, key_list_list, sink_list, previous):
+        cleaned_data = clean_data(data, key_list)
+        if previous_run is None:
+            result = generate_dependece_graph_chunked(cleaned_data, chunk_size, sink, manifest)
+        else:
+            snapshot, edges = previous_run
+            result = update_dependence_graph(cleaned_data, snapshot, edges, chunk_size, sink, manifest)
+        result_list.append(resolve_dependence(result, cleaned_data))
+
+    if not mix_key_list_list:
+        return result_list, None
+
+    cleaned_data_1 = clean_data(data_list[0], mix_key_list_list[0])
+    cleaned_data_2 = clean_data(data_list[1], mix_key_list_list[1])
+    previous_run = previous[len(data_list)]
+    if previous_run is None:
+        result_fusion = generate_dependece_fusion_tiled(cleaned_data_1, cleaned_data_2, chunk_size, min_score,
+                                                        sink_list[len(data_list)], manifest)
+    else:
+        (snapshot_1, snapshot_2), edges = previous_run
+        result_fusion = update_dependence_fusion(cleaned_data_1, cleaned_data_2, snapshot_1, snapshot_2, edges,
+                                                 chunk_size, sink_list[len(data_list)], manifest)
+    result_fusion = resolve_dependence(result_fusion, cleaned_data_1, cleaned_data_2, "fusion edges")
+    return result_list, result_fusion
 
-    with open(fusion_save_path, "w", encoding='utf-8') as f:
-        json.dump(result_fusion, f, indent=4)
+def main():
+    chunk_size = int(pop_option(sys.argv, "--chunk-size", 100))
+    pop_prompt_options(sys.argv)
+    min_score = pop_option(sys.argv, "--prune-score")
+    min_score = float(min_score) if min_score is not None else None
+    stream = "--stream" in sys.argv
+    if stream:
+        sys.argv.remove("--stream")
+    resume = "--resume" in sys.argv
+    if resume:
+        sys.argv.remove("--resume")
+    incremental = "--incremental" in sys.argv
+    if incremental:
+        sys.argv.remove("--incremental")
+    args = parse_args(sys.argv)
+    if args is None:
+        return
+    json_path_list, key_list_list, mix_key_list_list = args
+    sink_path_list = stream_sink_path_list(json_path_list, reset=not resume) if stream else None
+    manifest = JobManifest(manifest_path(json_path_list), resume)
+
+    data_list = []
+    for file_path in json_path_list:
+        with open(file_path, encoding='utf-8') as f:
+            data_list.append(json.load(f))
+
+    previous = load_previous_run(json_path_list) if incremental else None
+    result_list, result_fusion = run_dependence(data_list, key_list_list, mix_key_list_list, chunk_size, min_score,
+                                                sink_path_list, manifest, previous)
+    print(f"job manifest {manifest.path}: {manifest.summary()}")
+    print(call_metrics.format_summary())
+
+    for file_path, result in zip(json_path_list, result_list):
+        save_path = os.path.join("./data/", dependence_file_name(file_path))
+        with open(save_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=4)
     
+    if result_fusion is not None:
+        fusion_save_path = os.path.join("./data/", fusion_file_name(json_path_list))
+        with open(fusion_save_path, "w", encoding='utf-8') as f:
+            json.dump(result_fusion, f, indent=4)
+
+    # an interrupted stream leaves items unqueried, so a later --incremental run has to see them as new
+    if manifest.summary().get("partial"):
+        print("some chunks were cut off mid-stream, snapshot not saved; rerun with --resume")
+        return
+    save_snapshots(json_path_list, data_list, key_list_list, mix_key_list_list)
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
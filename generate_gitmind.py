@@ -1,91 +1,50 @@
-import string
-import random
 import time
 import os
 import sys
+import io
 import json
 import zipfile
+from itertools import chain
+from tree_traversal import iter_tree
+from util import pop_option, is_batch_args, expand_input_paths, is_up_to_date, atomic_write, run_batch
 
 os.makedirs("./data", exist_ok=True)
 
-def generate_random_string(length=32):
-    characters = string.ascii_lowercase + string.digits
-    return ''.join(random.choice(characters) for _ in range(length))
+export_config = {
+    "expand_depth": None,
+    "shard_nodes": None,
+    "shard_bytes": None
+}
 
-def find_node_in_tree(tree, node_id):
-    if len(tree) == 0:
-        return {}
-    
-    if tree['id'] == node_id:
-        return tree
-    
-    for child in tree.get('children', []):
-        result = find_node_in_tree(child, node_id)
-        if result:
-            return result
-    return {}
+def generate_random_string(length=32):
+    return os.urandom((length + 1) // 2).hex()[:length]
 
 def get_current_timestamp():
     return int(time.time() * 1000)
 
-def find_path_to_node(tree, node_id, path=None):
-    if path is None:
-        path = []
-    path.append(tree["id"])  # 将当前节点 ID 加入路径
-    if tree["id"] == node_id:
-        return path
-    for child in tree.get("children", []):
-        result = find_path_to_node(child, node_id, path.copy())  # 递归查找子节点
-        if result:
-            return result
-    return None
-
-def find_last_common_ancestor(path_1, path_2):
-    last_common_ancestor = None
-    for id_1, id_2 in zip(path_1, path_2):
-        if id_1 == id_2:
-            last_common_ancestor = id_1
-        else:
-            break
-    return last_common_ancestor
-
-def compare_nodes_vertical_position(tree, id_1, id_2):
-    path_1 = find_path_to_node(tree, id_1)
-    path_2 = find_path_to_node(tree, id_2)
-
-    if not path_1 or not path_2:
-        return False
-
-    if len(path_1) != len(path_2):
-        raise Exception("id_1 isn't in the same level with id_2")
-
-    last_common_ancestor_id = find_last_common_ancestor(path_1, path_2)
-
-    last_common_ancestor = find_node_in_tree(tree, last_common_ancestor_id)
-
-    # 找到两个节点在公共祖先的 children 中的索引
-    index_1 = next((i for i, child in enumerate(last_common_ancestor["children"]) if child["id"] == path_1[path_1.index(last_common_ancestor_id) + 1]), None)
-    index_2 = next((i for i, child in enumerate(last_common_ancestor["children"]) if child["id"] == path_2[path_2.index(last_common_ancestor_id) + 1]), None)
-
-    # 比较索引
-    if index_1 is not None and index_2 is not None and index_1 < index_2:
-        return 1
-    return -1
-
-def find_node_level(tree, node_id):
-    def dfs(node, current_level):
-        if node['id'] == node_id:
-            return current_level
-        for child in node['children']:
-            result = dfs(child, current_level + 1)
-            if result != -1:
-                return result
+class TreeIndex:
+    def __init__(self, tree):
+        # pre-order positions order nodes of the same level from top to bottom
+        self.level = {}
+        self.enter = {}
+        for clock, (node, level, _) in enumerate(iter_tree(tree)):
+            self.level[node['id']] = level
+            self.enter[node['id']] = clock
+
+    def find_node_level(self, node_id):
+        return self.level.get(node_id, -1)
+
+    def compare_nodes_vertical_position(self, id_1, id_2):
+        if id_1 not in self.level or id_2 not in self.level:
+            return False
+        if self.level[id_1] != self.level[id_2]:
+            raise Exception("id_1 isn't in the same level with id_2")
+        if self.enter[id_1] < self.enter[id_2]:
+            return 1
         return -1
 
-    return dfs(tree, 1)
-
 
-def transform_line(tree, right=True):
+def iter_transform_line(tree, right=True):
     id_text = {}
     for node in tree['nodes']:
         id_text[node['id']] = node['text']
@@ -95,16 +54,16 @@ def transform_line(tree, right=True):
         "text-line-through": False,
         "line-type": "line"
     }
-    result = []
+    tree_index = TreeIndex(tree['structure'])
     for edge in tree['additional_edges']:
         source_id = edge['fromId']
         target_id = edge['toId']
         line_id = edge['id']
-        source_level = find_node_level(tree['structure'], source_id)
-        target_level = find_node_level(tree['structure'], target_id)
+        source_level = tree_index.find_node_level(source_id)
+        target_level = tree_index.find_node_level(target_id)
         id_text[line_id] = ""
         if source_level == target_level:
-            source_is_up = compare_nodes_vertical_position(tree['structure'], source_id, target_id)
+            source_is_up = tree_index.compare_nodes_vertical_position(source_id, target_id)
             line = {
                 "data": {
                     "id": line_id,
@@ -125,7 +84,7 @@ def transform_line(tree, right=True):
                 },
                 "style": style
             }
-            result.append(line)
+            yield line
             continue
         source_is_left = 1 if source_level < target_level else -1
         source_is_left *= 1 if right else -1
@@ -149,51 +108,81 @@ def transform_line(tree, right=True):
             },
             "style": style
         }
-        result.append(line)
-    return result
+        yield line
+
+def transform_line(tree, right=True):
+    return list(iter_transform_line(tree, right))
+
+def transform_node_data(node, id_text, level, right=True):
+    global export_config
+    expand_depth = export_config["expand_depth"]
+    data = {
+        "id": node["id"],
+        "expanded": expand_depth is None or level < expand_depth,
+        "text": f"{id_text[node['id']]}",  
+        "html": f"<p>{id_text[node['id']]}</p>",  
+    }
+    if level == 1:
+        data['mindLayoutSplitIndex'] = len(node['children']) if right else 0
+    elif level == 2:
+        data["timeSnippet"] = ""
+    style = {
+        "text-underline": False,
+        "text-line-through": False
+    }
+    
+    return {
+        "data": data,
+        "style": style
+    }
 
 def transform_tree(tree, right=True):
     id_text = {}
     for node in tree['nodes']:
         id_text[node['id']] = node['text']
-    level = 0
-    def transform_node(node, id_text, level, right=True):
-        data = {
-            "id": node["id"],
-            "expanded": True,  
-            "text": f"{id_text[node['id']]}",  
-            "html": f"<p>{id_text[node['id']]}</p>",  
-        }
-        if level == 1:
-            data['mindLayoutSplitIndex'] = len(node['children']) if right else 0
-        elif level == 2:
-            data["timeSnippet"] = ""
-        style = {
-            "text-underline": False,
-            "text-line-through": False
-        }
-        
-        new_node = {
-            "data": data,
-            "style": style
-        }
-
-        if "children" in node and node["children"]:
-            new_node["children"] = [transform_node(child, id_text, level+1, right) for child in node["children"]]
-
-        return new_node
-
-    return transform_node(tree['structure'], id_text, level+1, right)
+    root = None
+    new_nodes = {}
+    for node, level, parent in iter_tree(tree['structure']):
+        new_node = transform_node_data(node, id_text, level, right)
+        if parent is None:
+            root = new_node
+        else:
+            new_nodes[parent['id']].setdefault("children", []).append(new_node)
+        if node.get("children"):
+            new_nodes[node['id']] = new_node
+    return root
 
-def convert_tree_to_gitmind(json_data, right=True):
-    random_id = generate_random_string()
-    
-    current_time = get_current_timestamp()
-    
-    transformed_root = transform_tree(json_data, right)
-    transformed_rel_lines = transform_line(json_data, right)
-    
-    gitmind_data = {
+def iter_transform_tree_json(tree, right=True, position=None):
+    id_text = {}
+    for node in tree['nodes']:
+        id_text[node['id']] = node['text']
+    # in pre-order, a node at level n closes every open children list deeper than n - 1
+    open_num = 0
+    opened = True
+    for node, level, _ in iter_tree(tree['structure']):
+        while open_num > level - 1:
+            yield "]}"
+            open_num -= 1
+            opened = False
+        if not opened:
+            yield ", "
+        new_node = transform_node_data(node, id_text, level, right)
+        if level == 1 and position is not None:
+            new_node['data']['position'] = position
+        node_json = json.dumps(new_node)
+        if node.get("children"):
+            yield node_json[:-1] + ', "children": ['
+            open_num += 1
+            opened = True
+        else:
+            yield node_json
+            opened = False
+    while open_num > 0:
+        yield "]}"
+        open_num -= 1
+
+def gitmind_header(random_id, current_time):
+    return {
         "id": random_id,
         "created": current_time,
         "modified": current_time,
@@ -212,22 +201,190 @@ def convert_tree_to_gitmind(json_data, right=True):
                 "structTheme": "mind-arc"
             }
         },
-        "root": transformed_root,
+        "root": None,
         "floatRoots": [],
-        "relLines": transformed_rel_lines,
+        "relLines": [],
         "watermark": {
             "id": random_id,
             "show": False
         }
     }
-    return gitmind_data
 
+def convert_tree_to_gitmind(json_data, right=True):
+    random_id = generate_random_string()
+    
+    current_time = get_current_timestamp()
+    
+    gitmind_data = gitmind_header(random_id, current_time)
+    gitmind_data["root"] = transform_tree(json_data, right)
+    gitmind_data["relLines"] = transform_line(json_data, right)
+    return gitmind_data
 
-def transform_mix_line(json_data):
-    result = []
+def iter_gitmind_json(root_chunks, float_root_chunks_list=(), rel_lines=()):
+    random_id = generate_random_string()
+    header = gitmind_header(random_id, get_current_timestamp())
+    yield "{"
+    for idx, (key, value) in enumerate(header.items()):
+        if idx > 0:
+            yield ", "
+        yield json.dumps(key) + ": "
+        if key == "root":
+            yield from root_chunks
+        elif key == "floatRoots":
+            yield "["
+            for float_idx, float_root_chunks in enumerate(float_root_chunks_list):
+                if float_idx > 0:
+                    yield ", "
+                yield from float_root_chunks
+            yield "]"
+        elif key == "relLines":
+            yield "["
+            for line_idx, line in enumerate(rel_lines):
+                if line_idx > 0:
+                    yield ", "
+                yield json.dumps(line)
+            yield "]"
+        else:
+            yield json.dumps(value)
+    yield "}"
+
+def write_gitmind(output_path, chunks):
+    def write(tmp_path):
+        with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED) as zipf:
+            with zipf.open("content.json", 'w') as raw_f:
+                with io.TextIOWrapper(raw_f, encoding='utf-8') as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+    atomic_write(output_path, write)
+
+
+def pop_export_options(argv):
+    global export_config
+    for option, key, scale in (("--expand-depth", "expand_depth", 1), ("--shard-nodes", "shard_nodes", 1),
+                               ("--shard-kb", "shard_bytes", 1024)):
+        value = pop_option(argv, option)
+        export_config[key] = int(value) * scale if value is not None else None
+    return dict(export_config)
+
+def estimate_node_bytes(text):
+    # roughly what transform_node_data serialises to: fixed keys plus the text twice (text and html)
+    return 160 + 2 * len(str(text).encode('utf-8'))
+
+def find_shard_cuts(tree, id_text, max_nodes=None, max_bytes=None):
+    # post-order pass: while a subtree is over budget, its largest remaining child subtree is cut off into its own shard
+    max_nodes = max_nodes or float("inf")
+    max_bytes = max_bytes or float("inf")
+    # relation lines are charged to their source node; a serialised line takes about 300 bytes
+    line_bytes = {}
+    for edge in tree['additional_edges']:
+        line_bytes[edge['fromId']] = line_bytes.get(edge['fromId'], 0) + 300
+    cut_ids = set()
+    remaining = {}
+    # reversed pre-order visits every child before its parent
+    for node, _, _ in reversed(list(iter_tree(tree['structure']))):
+        children = node.get('children', [])
+        node_num = 1
+        node_bytes = estimate_node_bytes(id_text[node['id']]) + line_bytes.get(node['id'], 0)
+        child_sizes = []
+        for child in children:
+            child_num, child_bytes = remaining.pop(child['id'])
+            node_num += child_num
+            node_bytes += child_bytes
+            child_sizes.append((child_bytes, child_num, child['id']))
+        child_sizes.sort(reverse=True)
+        for child_bytes, child_num, child_id in child_sizes:
+            if node_num <= max_nodes and node_bytes <= max_bytes:
+                break
+            cut_ids.add(child_id)
+            # the cut child stays behind as a single link node
+            node_num -= child_num - 1
+            node_bytes -= child_bytes - estimate_node_bytes(id_text[child_id]) - 64
+        remaining[node['id']] = (node_num, node_bytes)
+    return cut_ids
+
+def shard_tree(tree, shard_name, max_nodes=None, max_bytes=None):
+    id_text = {node['id']: node['text'] for node in tree['nodes']}
+    cut_ids = find_shard_cuts(tree, id_text, max_nodes, max_bytes)
+    if not cut_ids:
+        return [(shard_name(0), tree)]
+    shard_list = []
+    queue = [tree['structure']]
+    while len(shard_list) < len(queue):
+        shard_root = queue[len(shard_list)]
+        shard_nodes = []
+        member_ids = set()
+        structure = {'id': shard_root['id'], 'children': []}
+        stack = [(shard_root, structure)]
+        while stack:
+            node, new_node = stack.pop()
+            member_ids.add(node['id'])
+            shard_nodes.append({"id": node['id'], "text": id_text[node['id']]})
+            for child in node.get('children', []):
+                new_child = {'id': child['id'], 'children': []}
+                new_node['children'].append(new_child)
+                if child['id'] in cut_ids:
+                    queue.append(child)
+                    shard_nodes.append({"id": child['id'], "text": f"{id_text[child['id']]} [{shard_name(len(queue) - 1)}]"})
+                else:
+                    stack.append((child, new_child))
+        additional_edges = [edge for edge in tree['additional_edges']
+                            if edge['fromId'] in member_ids and edge['toId'] in member_ids]
+        shard_list.append((shard_name(len(shard_list)), {
+            "structure": structure,
+            "additional_edges": additional_edges,
+            "nodes": shard_nodes
+        }))
+    return shard_list
+
+def replace_shard_list(output_path, output_path_list):
+    # <output>.parts lists the part files written for output_path, so a rerun with fewer shards
+    # only removes files it created itself and never another input's output
+    list_path = output_path + ".parts"
+    dir_name = os.path.dirname(output_path)
+    if os.path.exists(list_path):
+        with open(list_path, encoding='utf-8') as f:
+            for name in f.read().split("\n"):
+                path = os.path.join(dir_name, name)
+                if name and path not in output_path_list and os.path.exists(path):
+                    os.remove(path)
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(os.path.basename(path) for path in output_path_list[1:]))
+    atomic_write(list_path, write)
+
+def write_single_gitmind(output_path, tree):
+    # the first shard keeps output_path and is the overview; link nodes name the file of their subtree
+    global export_config
+    if export_config["shard_nodes"] is None and export_config["shard_bytes"] is None:
+        write_gitmind(output_path, iter_single_gitmind_json(tree))
+        return [output_path]
+    base_path = output_path[:-len(".gmind")] if output_path.endswith(".gmind") else output_path
+    shard_name = lambda idx: os.path.basename(output_path) if idx == 0 else f"{os.path.basename(base_path)}_part{idx:03d}.gmind"
+    output_path_list = []
+    kept_num = 0
+    for name, shard in shard_tree(tree, shard_name, export_config["shard_nodes"], export_config["shard_bytes"]):
+        path = os.path.join(os.path.dirname(output_path), name)
+        write_gitmind(path, iter_single_gitmind_json(shard))
+        output_path_list.append(path)
+        kept_num += len(shard['additional_edges'])
+    replace_shard_list(output_path, output_path_list)
+    dropped_num = len(tree['additional_edges']) - kept_num
+    if dropped_num > 0:
+        print(f"{os.path.basename(output_path)}: dropped {dropped_num} of {len(tree['additional_edges'])} relation lines "
+              f"that cross shard files")
+    return output_path_list
+
+def write_merged_gitmind(output_path, tree_1, tree_2, mix_edges):
+    global export_config
+    if export_config["shard_nodes"] is not None or export_config["shard_bytes"] is not None:
+        print(f"{os.path.basename(output_path)}: merged maps are not sharded, --shard-nodes/--shard-kb ignored")
+    write_gitmind(output_path, iter_merged_gitmind_json(tree_1, tree_2, mix_edges))
+    return [output_path]
+
+def iter_transform_mix_line(json_data):
     for edge in json_data:
         source_is_left = edge['right']
-        result.append({
+        yield {
             "data": {
                 "id": edge['id'],
                 "fromId": edge['fromId'],
@@ -250,15 +407,74 @@ def transform_mix_line(json_data):
                 "text-line-through": False,
                 "line-type": "line"
             }
-        })
-    return result
+        }
+
+def transform_mix_line(json_data):
+    return list(iter_transform_mix_line(json_data))
+
+def iter_single_gitmind_json(tree):
+    return iter_gitmind_json(
+        iter_transform_tree_json(tree),
+        rel_lines=iter_transform_line(tree)
+    )
+
+def iter_merged_gitmind_json(tree_1, tree_2, mix_edges):
+    position = {
+        "x": 2000,
+        "y": 0
+    }
+    return iter_gitmind_json(
+        iter_transform_tree_json(tree_1),
+        [iter_transform_tree_json(tree_2, right=False, position=position)],
+        chain(
+            iter_transform_line(tree_1),
+            iter_transform_line(tree_2, right=False),
+            iter_transform_mix_line(mix_edges)
+        )
+    )
+
+def convert_tree_file(file_path, output_dir, config=None):
+    global export_config
+    if config is not None:
+        export_config.update(config)
+    with open(file_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or 'structure' not in data:
+        raise Exception("not a tree file, fusion edge lists need the three path form")
+    output_path = os.path.join(output_dir, os.path.basename(file_path).replace("_tree.json", ".gmind"))
+    return write_single_gitmind(output_path, data)
+
+def convert_tree_dir(arg_list, output_dir="./data", force=False, max_workers=None):
+    global export_config
+    os.makedirs(output_dir, exist_ok=True)
+    task_list = []
+    skipped_num = 0
+    for file_path in expand_input_paths(arg_list, ("_tree.json",)):
+        output_path = os.path.join(output_dir, os.path.basename(file_path).replace("_tree.json", ".gmind"))
+        if not force and is_up_to_date(file_path, [output_path]):
+            skipped_num += 1
+            continue
+        task_list.append((file_path, output_dir, dict(export_config)))
+    failed_num = run_batch(convert_tree_file, task_list, max_workers)
+    print(f"{len(task_list) - failed_num} converted, {skipped_num} up to date, {failed_num} failed")
+    return failed_num
 
 def main():
+    pop_export_options(sys.argv)
+    output_dir = pop_option(sys.argv, "--output-dir", "./data")
+    max_workers = pop_option(sys.argv, "--workers")
+    max_workers = int(max_workers) if max_workers is not None else None
+    force = "--force" in sys.argv
+    if force:
+        sys.argv.remove("--force")
     if len(sys.argv) < 2:
         print("please provide at least one parameter as the json path")
         return
     
     file_path_list = sys.argv[1:]
+    if is_batch_args(file_path_list):
+        convert_tree_dir(file_path_list, output_dir, force, max_workers)
+        return
     if len(file_path_list) not in [1, 3]:
         print("only 1 or 3 json json paths are supported.")
         return
@@ -276,36 +492,21 @@ def main():
             data = json.load(f)
         data_list.append(data)
     
+    os.makedirs(output_dir, exist_ok=True)
     end_idx = 1 if len(file_path_list) == 1 else 2
     for idx in range(end_idx):
-        result = convert_tree_to_gitmind(data_list[idx])
         base_name = os.path.basename(file_path_list[idx])
         output_name = base_name.replace("_tree.json", ".gmind")
         
-        with zipfile.ZipFile(f"./data/{output_name}", 'w') as zipf:
-            zipf.writestr("content.json", json.dumps(result))
+        write_single_gitmind(os.path.join(output_dir, output_name), data_list[idx])
 
     if len(file_path_list) == 1:
         return
     
-    gitmind_0 = convert_tree_to_gitmind(data_list[0])
-    gitmind_1 = convert_tree_to_gitmind(data_list[1], right=False)
-    mix_lines = transform_mix_line(data_list[-1])
-
-    gitmind_1['root']['data']['position'] = {
-        "x": 2000,
-        "y": 0
-    }
-
-    gitmind_0['floatRoots'].append(gitmind_1['root'])
-    gitmind_0['relLines'].extend(gitmind_1['relLines'])
-    gitmind_0['relLines'].extend(mix_lines)
-    
     base_name = os.path.basename(file_path_list[-1])
 
     output_name = base_name.replace("_tree.json", ".gmind")
-    with zipfile.ZipFile(f"./data/{output_name}", 'w') as zipf:
-        zipf.writestr("content.json", json.dumps(gitmind_0))
+    write_merged_gitmind(os.path.join(output_dir, output_name), data_list[0], data_list[1], data_list[-1])
 
 
 if __name__ == "__main__":
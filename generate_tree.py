@@ -1,99 +1,69 @@
 import json
-import uuid
-from collections import defaultdict, deque
+from array import array
 import os
 import sys
+from util import pop_option, is_batch_args, expand_input_paths, is_up_to_date, atomic_write, run_batch
+from id_allocator import id_allocator
+from name_index import NameIndex
+from graph_core import CSRGraph, SpanningTree
+from graph_normalize import (strongly_connected_components, find_component_roots, transitive_reduction, choose_parents,
+                             spanning_strategies)
+from generate_gitmind import export_config, pop_export_options, write_single_gitmind
 
 os.makedirs("./data", exist_ok=True)
 
-def find_edge_in_tree(tree, source_id, target_id):
-    node = find_node_in_tree(tree, source_id)
-    if not node:
-        return False
-    if len(node['children']) == 0:
-        return False
-    return any(child['id'] == target_id for child in node['children'])
-
-def find_node_in_tree(tree, node_id):
-    if len(tree) == 0:
-        return {}
-    
-    if tree['id'] == node_id:
-        return tree
-    
-    for child in tree.get('children', []):
-        result = find_node_in_tree(child, node_id)
-        if result:
-            return result
-    return {}
-
-class HexIdGenerator:
-    _generated_ids = set()
-
-    @classmethod
-    def generate_hex_id(cls):
-        while True:
-            new_id = uuid.uuid4().hex[:10]
-
-            if new_id not in cls._generated_ids:
-                cls._generated_ids.add(new_id)
-                return new_id
-
-    @classmethod
-    def clear_generated_ids(cls):
-        cls._generated_ids.clear()
-
-def generate_tree(dependencies, root_name="root"):
-
-    node_id = {}
-    for node in set([item for sublist in [[d['source'], d['target']] for d in dependencies] for item in sublist]):
-        new_id = HexIdGenerator.generate_hex_id()
-        node_id[node] = new_id
+def generate_tree(dependencies, root_name="root", strategy="shallowest", reduce=False):
 
-    dep_dict = defaultdict(list)
+    node_index = {}
+    sources = array('q')
+    targets = array('q')
     for item in dependencies:
-        source_id = node_id[item['source']]
-        target_id = node_id[item['target']]
-        if target_id not in dep_dict[source_id]:
-            dep_dict[source_id].append(target_id)
+        for name, edge_nodes in ((item['source'], sources), (item['target'], targets)):
+            index = node_index.get(name)
+            if index is None:
+                index = node_index[name] = len(node_index)
+            edge_nodes.append(index)
+    node_num = len(node_index)
+
+    graph = CSRGraph.from_edges(node_num, sources, targets)
+    del sources, targets
+
+    if reduce:
+        graph = transitive_reduction(graph)
     
-    in_degree = defaultdict(int)
-    for source, targets in dep_dict.items():
-        for target in targets:
-            in_degree[target] += 1
-    roots = [node for node in dep_dict.keys() if in_degree[node] == 0]
+    roots = find_component_roots(graph, strongly_connected_components(graph))
     
     if len(roots) == 0:
         raise Exception("can't find root in directed node")
 
     if len(roots) > 1:
-        virtual_root_id = HexIdGenerator.generate_hex_id()
-        node_id[root_name] = virtual_root_id
-        dep_dict[virtual_root_id] = roots
-        roots = [virtual_root_id]
+        graph, virtual_root = graph.with_root(roots)
+        roots = [virtual_root]
     
-    tree = {'id': roots[0], 'children': []}
-    nodes_queue = deque(roots)
-
-    visited_node_ids = roots
-    while nodes_queue:
-        current_id = nodes_queue.popleft()
-        current_node = find_node_in_tree(tree, current_id)
-        children = []
-        for child_id in dep_dict.get(current_id, []):
-            if child_id not in visited_node_ids:
-                visited_node_ids.append(child_id)
-                children.append({'id': child_id, 'children': []})
-                nodes_queue.append(child_id)
-        current_node['children'] = children
+    spanning_tree = SpanningTree(graph, roots[0], choose_parents(graph, roots, strategy))
+
+    # hex ids are only materialised here
+    node_id = {}
+    hex_ids = [None] * graph.node_num
+    if id_allocator.seed is None:
+        for (name, index), new_id in zip(node_index.items(), id_allocator.allocate_many(node_num)):
+            node_id[name] = hex_ids[index] = new_id
+    else:
+        for name, index in node_index.items():
+            node_id[name] = hex_ids[index] = id_allocator.allocate(name)
+    if graph.node_num > node_num:
+        virtual_root_id = id_allocator.allocate(f"root\0{root_name}")
+        node_id[root_name] = virtual_root_id
+        hex_ids[node_num] = virtual_root_id
+
+    tree = spanning_tree.export(hex_ids)
     
     additional_edges = []
-    for source, targets in dep_dict.items():
-        for target in targets:
-            found = find_edge_in_tree(tree, source_id=source, target_id=target)
-            if not found:
-                line_id = HexIdGenerator.generate_hex_id()
-                additional_edges.append({"id": line_id, "fromId": source, "toId": target})
+    for source in graph.source_order:
+        for target in graph.neighbors(source):
+            if not spanning_tree.is_tree_edge(source, target):
+                line_id = id_allocator.allocate(f"edge\0{hex_ids[source]}\0{hex_ids[target]}")
+                additional_edges.append({"id": line_id, "fromId": hex_ids[source], "toId": hex_ids[target]})
 
     output = {
         "structure": tree,
@@ -103,72 +73,177 @@ def generate_tree(dependencies, root_name="root"):
     return output
 
 
+def generate_fusion_edges(dependencies, node_set_list, total_node_id):
+    result = []
+    name_index = NameIndex(total_node_id)
+    dropped_num = 0
+    for edge in dependencies:
+        source = name_index.resolve(edge['source'])
+        target = name_index.resolve(edge['target'])
+        if source is None or target is None:
+            dropped_num += 1
+            continue
+        if source in node_set_list[0] and target not in node_set_list[1]:
+            continue
+        if source in node_set_list[1] and target not in node_set_list[0]:
+            continue
+        right = 1 if source in node_set_list[0] else -1
+        
+        result.append({
+            "id": id_allocator.allocate(f"fusion\0{total_node_id[source]}\0{total_node_id[target]}"),
+            "fromId": total_node_id[source],
+            "toId": total_node_id[target],
+            "right": right
+        })
+    print(name_index.report("fusion edge names"))
+    if dropped_num > 0:
+        print(f"dropped {dropped_num} fusion edges with unresolved names")
+    return result
+
+def load_dependence(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        if not file_path.endswith(".jsonl"):
+            return json.load(f)
+        data = []
+        visited_edges = set()
+        for line in f:
+            if not line.strip():
+                continue
+            edge = json.loads(line)
+            if (edge['source'], edge['target']) not in visited_edges:
+                visited_edges.add((edge['source'], edge['target']))
+                data.append(edge)
+        return data
+
+def generate_trees(data_list, root_name_list, strategy="shallowest", reduce=False):
+    end_idx = 1 if len(data_list) == 1 else 2
+    node_set_list = [set() for _ in range(end_idx)]
+    total_node_id = dict()
+    tree_list = []
+    for idx in range(end_idx):
+        result = generate_tree(data_list[idx], root_name_list[idx], strategy, reduce)
+        for node in result['nodes']:
+            node_set_list[idx].add(node['text'])
+            total_node_id[node['text']] = node['id']
+        tree_list.append(result)
+
+    if len(data_list) == 1:
+        return tree_list, None
+    return tree_list, generate_fusion_edges(data_list[-1], node_set_list, total_node_id)
+
+
+def write_json(path, data):
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=4)
+    atomic_write(path, write)
+
+def tree_output_path(file_path, output_dir):
+    base_name = os.path.basename(file_path).replace(".jsonl", ".json")
+    return os.path.join(output_dir, base_name.replace("dependence", "tree"))
+
+def is_fusion_input(file_path):
+    # a fusion list is named <a>_<b>_dependence.json next to the dependence lists of both of its inputs
+    dir_name, base_name = os.path.split(file_path)
+    for suffix in ("_dependence.json", "_dependence.jsonl"):
+        if not base_name.endswith(suffix):
+            continue
+        stem = base_name[:-len(suffix)]
+        for idx, char in enumerate(stem):
+            if char != "_":
+                continue
+            part_list = [stem[:idx], stem[idx + 1:]]
+            if all(any(os.path.exists(os.path.join(dir_name, part + part_suffix))
+                       for part_suffix in ("_dependence.json", "_dependence.jsonl")) for part in part_list):
+                return True
+    return False
+
+def build_tree_file(file_path, output_dir, strategy="shallowest", reduce=False, seed=None, gitmind=False, config=None):
+    # every file gets a fresh allocator state, so seeded ids do not depend on which worker picks the file up
+    id_allocator.reset(seed)
+    if config is not None:
+        export_config.update(config)
+    root_name = os.path.basename(file_path).split("_")[0]
+    result = generate_tree(load_dependence(file_path), root_name, strategy, reduce)
+    output_path = tree_output_path(file_path, output_dir)
+    write_json(output_path, result)
+    if not gitmind:
+        return [output_path]
+    return [output_path] + write_single_gitmind(output_path.replace("_tree.json", ".gmind"), result)
+
+def build_tree_dir(arg_list, output_dir="./data", strategy="shallowest", reduce=False, seed=None, gitmind=False,
+                   force=False, max_workers=None):
+    os.makedirs(output_dir, exist_ok=True)
+    task_list = []
+    skipped_num = 0
+    for file_path in expand_input_paths(arg_list, ("_dependence.json", "_dependence.jsonl")):
+        if is_fusion_input(file_path):
+            print(f"skipped {file_path}: fusion edge lists need the three path form")
+            continue
+        output_path = tree_output_path(file_path, output_dir)
+        output_path_list = [output_path, output_path.replace("_tree.json", ".gmind")] if gitmind else [output_path]
+        if not force and is_up_to_date(file_path, output_path_list):
+            skipped_num += 1
+            continue
+        task_list.append((file_path, output_dir, strategy, reduce, seed, gitmind, dict(export_config)))
+    failed_num = run_batch(build_tree_file, task_list, max_workers)
+    print(f"{len(task_list) - failed_num} built, {skipped_num} up to date, {failed_num} failed")
+    return failed_num
+
+
 def main():
-    HexIdGenerator.clear_generated_ids()
+    pop_export_options(sys.argv)
+    seed = pop_option(sys.argv, "--seed")
+    id_allocator.reset(seed)
+    strategy = pop_option(sys.argv, "--strategy", "shallowest")
+    if strategy not in spanning_strategies:
+        print(f"error: unknown spanning strategy {strategy}, choose from {', '.join(spanning_strategies)}")
+        return
+    output_dir = pop_option(sys.argv, "--output-dir", "./data")
+    max_workers = pop_option(sys.argv, "--workers")
+    max_workers = int(max_workers) if max_workers is not None else None
+    reduce = "--reduce" in sys.argv
+    if reduce:
+        sys.argv.remove("--reduce")
+    gitmind = "--gitmind" in sys.argv
+    if gitmind:
+        sys.argv.remove("--gitmind")
+    force = "--force" in sys.argv
+    if force:
+        sys.argv.remove("--force")
     if len(sys.argv) < 2:
         print("please provide at least one parameter as the json path")
         return
     file_path_list = sys.argv[1:]
+    if is_batch_args(file_path_list):
+        build_tree_dir(file_path_list, output_dir, strategy, reduce, seed, gitmind, force, max_workers)
+        return
     if len(file_path_list) not in [1, 3]:
         print("only 1 or 3 json json paths are supported.")
         return
-    end_idx = 1 if len(file_path_list) == 1 else 2
     
     data_list = []
     for file_path in file_path_list:
-        if not file_path.endswith("_dependence.json"):
-            print(f"error: {file_path} should end with '_dependence.json'")
+        if not file_path.endswith(("_dependence.json", "_dependence.jsonl")):
+            print(f"error: {file_path} should end with '_dependence.json' or '_dependence.jsonl'")
             return
 
         if not os.path.exists(file_path):
             print(f"error：file {file_path} doesn't exist")
             return
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        data_list.append(data)
+        data_list.append(load_dependence(file_path))
     
-    node_set_list = [set() for _ in range(end_idx)]
-    total_node_id = dict()
     root_name_list = [os.path.basename(path).split("_")[0] for path in file_path_list]
-    for idx in range(end_idx):
-        data = data_list[idx]
-        root_name = root_name_list[idx]
-        node_set = node_set_list[idx]
-        file_path = file_path_list[idx]
-        result = generate_tree(data, root_name)
-        for node in result['nodes']:
-            node_set.add(node['text'])
-            total_node_id[node['text']] = node['id']
-        base_name = os.path.basename(file_path)
-        output_name = base_name.replace("dependence", "tree")
-        with open(f'./data/{output_name}', 'w', encoding="utf-8") as f:
-            json.dump(result, f, indent=4)
+    tree_list, fusion_result = generate_trees(data_list, root_name_list, strategy, reduce)
+
+    os.makedirs(output_dir, exist_ok=True)
+    for file_path, result in zip(file_path_list, tree_list):
+        write_json(tree_output_path(file_path, output_dir), result)
     
-    if len(file_path_list) == 1:
+    if fusion_result is None:
         return
     
-    result = []
-    for edge in data_list[-1]:
-        source = edge['source']
-        target = edge['target']
-        if source not in total_node_id or target not in total_node_id:
-            continue
-        if source in node_set_list[0] and target not in node_set_list[1]:
-            continue
-        if source in node_set_list[1] and target not in node_set_list[0]:
-            continue
-        right = 1 if source in node_set_list[0] else -1
-        
-        result.append({
-            "id":  HexIdGenerator.generate_hex_id(),
-            "fromId": total_node_id[source],
-            "toId": total_node_id[target],
-            "right": right
-        })
-    base_name = os.path.basename(file_path_list[-1])
-    output_name = base_name.replace("dependence", "tree")
-    with open(f"./data/{output_name}", 'w', encoding='utf-8') as f:
-        json.dump(result, f, indent=4)
+    write_json(tree_output_path(file_path_list[-1], output_dir), fusion_result)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,86 @@
+from array import array
+
+
+class CSRGraph:
+    __slots__ = ("node_num", "offsets", "targets", "source_order")
+
+    def __init__(self, node_num, offsets, targets, source_order):
+        self.node_num = node_num
+        self.offsets = offsets
+        self.targets = targets
+        self.source_order = source_order
+
+    @classmethod
+    def from_edges(cls, node_num, sources, targets):
+        # keeps the first occurrence of every edge and the input order within each source
+        visited_edges = set()
+        out_degree = array('q', bytes(8 * (node_num + 1)))
+        source_order = array('q')
+        kept = array('q')
+        for idx in range(len(sources)):
+            source = sources[idx]
+            key = source * node_num + targets[idx]
+            if key in visited_edges:
+                continue
+            visited_edges.add(key)
+            if out_degree[source] == 0:
+                source_order.append(source)
+            out_degree[source] += 1
+            kept.append(idx)
+        return cls.build(node_num, out_degree, source_order, ((sources[idx], targets[idx]) for idx in kept))
+
+    @classmethod
+    def build(cls, node_num, out_degree, source_order, edges):
+        offsets = array('q', bytes(8 * (node_num + 1)))
+        for node in range(node_num):
+            offsets[node + 1] = offsets[node] + out_degree[node]
+        cursor = array('q', offsets)
+        targets = array('q', bytes(8 * offsets[node_num]))
+        for source, target in edges:
+            targets[cursor[source]] = target
+            cursor[source] += 1
+        return cls(node_num, offsets, targets, source_order)
+
+    def with_root(self, roots):
+        root = self.node_num
+        offsets = array('q', self.offsets)
+        offsets.append(offsets[-1] + len(roots))
+        targets = array('q', self.targets)
+        targets.extend(roots)
+        source_order = array('q', self.source_order)
+        source_order.append(root)
+        return CSRGraph(self.node_num + 1, offsets, targets, source_order), root
+
+    def neighbors(self, node):
+        offsets = self.offsets
+        return self.targets[offsets[node]:offsets[node + 1]]
+
+
+class SpanningTree:
+    __slots__ = ("graph", "root", "parent")
+
+    def __init__(self, graph, root, parent):
+        # parent[node] is the parent index of every node, -1 for the root
+        self.graph = graph
+        self.root = root
+        self.parent = parent
+
+    def children(self, node):
+        parent = self.parent
+        return [child for child in self.graph.neighbors(node) if parent[child] == node]
+
+    def is_tree_edge(self, source, target):
+        return self.parent[target] == source
+
+    def export(self, hex_ids):
+        tree = {'id': hex_ids[self.root], 'children': []}
+        stack = [(self.root, tree)]
+        while stack:
+            node, node_dict = stack.pop()
+            children = []
+            for child in self.children(node):
+                child_dict = {'id': hex_ids[child], 'children': []}
+                children.append(child_dict)
+                stack.append((child, child_dict))
+            node_dict['children'] = children
+        return tree
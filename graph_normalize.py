@@ -0,0 +1,246 @@
+from array import array
+from collections import deque
+from graph_core import CSRGraph
+
+spanning_strategies = ("shallowest", "specific", "widest")
+
+# above this many components the exact reduction (one reach bitset per live component) costs too much memory and time
+exact_reduction_limit = 50000
+
+
+class Components:
+    __slots__ = ("node_component", "offsets", "members")
+
+    def __init__(self, node_component, offsets, members):
+        # members of component c are members[offsets[c]:offsets[c + 1]]
+        self.node_component = node_component
+        self.offsets = offsets
+        self.members = members
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+def strongly_connected_components(graph):
+    node_num = graph.node_num
+    offsets = graph.offsets
+    targets = graph.targets
+    index = array('q', [-1]) * node_num
+    low_link = array('q', [0]) * node_num
+    on_stack = bytearray(node_num)
+    node_component = array('q', [-1]) * node_num
+    component_offsets = array('q', [0])
+    members = array('q')
+    stack = array('q')
+    # the DFS work stack holds a node and the position of its next edge
+    work_node = array('q')
+    work_edge = array('q')
+    counter = 0
+    for start in list(graph.source_order) + list(range(node_num)):
+        if index[start] != -1:
+            continue
+        index[start] = low_link[start] = counter
+        counter += 1
+        stack.append(start)
+        on_stack[start] = 1
+        work_node.append(start)
+        work_edge.append(offsets[start])
+        while work_node:
+            node = work_node[-1]
+            edge = work_edge[-1]
+            end = offsets[node + 1]
+            pushed = False
+            while edge < end:
+                child = targets[edge]
+                edge += 1
+                if index[child] == -1:
+                    work_edge[-1] = edge
+                    index[child] = low_link[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack[child] = 1
+                    work_node.append(child)
+                    work_edge.append(offsets[child])
+                    pushed = True
+                    break
+                if on_stack[child] and index[child] < low_link[node]:
+                    low_link[node] = index[child]
+            if pushed:
+                continue
+            work_node.pop()
+            work_edge.pop()
+            if work_node:
+                parent = work_node[-1]
+                if low_link[node] < low_link[parent]:
+                    low_link[parent] = low_link[node]
+            if low_link[node] == index[node]:
+                component = len(component_offsets) - 1
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = 0
+                    node_component[member] = component
+                    members.append(member)
+                    if member == node:
+                        break
+                component_offsets.append(len(members))
+    # Tarjan emits components in reverse topological order
+    return Components(node_component, component_offsets, members)
+
+
+def find_component_roots(graph, components):
+    node_component = components.node_component
+    offsets = graph.offsets
+    targets = graph.targets
+    has_parent = bytearray(len(components))
+    for source in graph.source_order:
+        source_component = node_component[source]
+        for edge in range(offsets[source], offsets[source + 1]):
+            target_component = node_component[targets[edge]]
+            if target_component != source_component:
+                has_parent[target_component] = 1
+    roots = []
+    for node in graph.source_order:
+        component = node_component[node]
+        if not has_parent[component]:
+            # marking the component keeps only its first node as a root
+            has_parent[component] = 1
+            roots.append(node)
+    return roots
+
+
+def component_children(graph, components):
+    # child components of every component, deduplicated, in edge order
+    node_component = components.node_component
+    offsets = graph.offsets
+    targets = graph.targets
+    children = [None] * len(components)
+    for source in graph.source_order:
+        source_component = node_component[source]
+        for edge in range(offsets[source], offsets[source + 1]):
+            target_component = node_component[targets[edge]]
+            if target_component == source_component:
+                continue
+            if children[source_component] is None:
+                children[source_component] = {}
+            children[source_component][target_component] = None
+    return [array('q', child_dict) if child_dict is not None else array('q') for child_dict in children]
+
+
+def two_hop_redundant(children, component_num):
+    # drops u -> w when some u -> v -> w exists; exact for most sparse graphs and linear in edges times child degree
+    redundant = set()
+    for component in range(component_num):
+        child_set = set(children[component])
+        for child in children[component]:
+            for grandchild in children[child]:
+                if grandchild in child_set:
+                    redundant.add(component * component_num + grandchild)
+    return redundant
+
+
+def exact_redundant(children, component_num):
+    parent_num = array('q', [0]) * component_num
+    for child_list in children:
+        for child in child_list:
+            parent_num[child] += 1
+
+    # a reach bitset is freed as soon as its last parent has read it, so only the frontier is kept
+    reach = [0] * component_num
+    redundant = set()
+    for component in range(component_num):
+        component_reach = 0
+        # higher component ids come first in topological order
+        for child in sorted(children[component], reverse=True):
+            if component_reach >> child & 1:
+                redundant.add(component * component_num + child)
+            else:
+                component_reach |= reach[child] | (1 << child)
+            parent_num[child] -= 1
+            if parent_num[child] == 0:
+                reach[child] = 0
+        if parent_num[component] > 0:
+            reach[component] = component_reach
+    return redundant
+
+
+def transitive_reduction(graph):
+    components = strongly_connected_components(graph)
+    component_num = len(components)
+    children = component_children(graph, components)
+    if component_num > exact_reduction_limit:
+        print(f"transitive reduction: {component_num} components, only removing 2-hop shortcuts")
+        redundant = two_hop_redundant(children, component_num)
+    else:
+        redundant = exact_redundant(children, component_num)
+    del children
+
+    node_component = components.node_component
+    offsets = graph.offsets
+    targets = graph.targets
+    out_degree = array('q', [0]) * (graph.node_num + 1)
+    kept_sources = array('q')
+    kept_targets = array('q')
+    for source in graph.source_order:
+        source_key = node_component[source] * component_num
+        for edge in range(offsets[source], offsets[source + 1]):
+            target = targets[edge]
+            if source_key + node_component[target] not in redundant:
+                out_degree[source] += 1
+                kept_sources.append(source)
+                kept_targets.append(target)
+    return CSRGraph.build(graph.node_num, out_degree, graph.source_order, zip(kept_sources, kept_targets))
+
+
+def choose_parents(graph, roots, strategy="shallowest"):
+    if strategy not in spanning_strategies:
+        raise Exception(f"unknown spanning strategy {strategy}")
+    offsets = graph.offsets
+    targets = graph.targets
+    parent = array('q', [-1]) * graph.node_num
+    visited = bytearray(graph.node_num)
+    for root in roots:
+        visited[root] = 1
+    bfs_order = array('q')
+    nodes_queue = deque(roots)
+    while nodes_queue:
+        current = nodes_queue.popleft()
+        for edge in range(offsets[current], offsets[current + 1]):
+            child = targets[edge]
+            if not visited[child]:
+                visited[child] = 1
+                parent[child] = current
+                bfs_order.append(child)
+                nodes_queue.append(child)
+    if strategy == "shallowest":
+        return parent
+
+    components = strongly_connected_components(graph)
+    node_component = components.node_component
+    if strategy == "specific":
+        component_depth = array('q', [0]) * len(components)
+        for component in range(len(components) - 1, -1, -1):
+            depth = component_depth[component] + 1
+            for member_idx in range(components.offsets[component], components.offsets[component + 1]):
+                node = components.members[member_idx]
+                for edge in range(offsets[node], offsets[node + 1]):
+                    target_component = node_component[targets[edge]]
+                    if target_component != component and component_depth[target_component] < depth:
+                        component_depth[target_component] = depth
+        score = array('q', (component_depth[node_component[node]] for node in range(graph.node_num)))
+    else:
+        score = array('q', (offsets[node + 1] - offsets[node] for node in range(graph.node_num)))
+
+    # the first candidate in edge order wins ties
+    best = array('q', [-1]) * graph.node_num
+    for source in graph.source_order:
+        source_component = node_component[source]
+        for edge in range(offsets[source], offsets[source + 1]):
+            target = targets[edge]
+            if node_component[target] == source_component:
+                continue
+            if best[target] == -1 or score[source] > score[best[target]]:
+                best[target] = source
+    for node in bfs_order:
+        if best[node] != -1:
+            parent[node] = best[node]
+    return parent
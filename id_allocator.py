@@ -0,0 +1,69 @@
+import os
+import hashlib
+
+
+class IdAllocator:
+    def __init__(self, length=10, seed=None):
+        self.length = length
+        self.reset(seed)
+
+    def reset(self, seed=None):
+        # counter ids go through a keyed Feistel permutation of length * 4 bits,
+        # so they stay unique until the counter wraps without remembering them
+        self.seed = seed
+        self.half_bits = self.length * 2
+        self.mask = (1 << self.half_bits) - 1
+        if seed is None:
+            key_bytes = os.urandom(16)
+        else:
+            key_bytes = hashlib.blake2b(str(seed).encode('utf-8'), digest_size=16).digest()
+        self.round_keys = [int.from_bytes(key_bytes[idx:idx + 4], 'big') for idx in range(0, 16, 4)]
+        self.counter = 0
+        # text ids are hashes, so seeded runs keep the ids issued by this allocator to resolve collisions
+        self.issued = {}
+
+    def permute(self, value):
+        mask = self.mask
+        half_bits = self.half_bits
+        left = value >> half_bits
+        right = value & mask
+        for round_key in self.round_keys:
+            mixed = ((right ^ round_key) * 0x9E3779B1) & 0xFFFFFFFFFFFF
+            left, right = right, left ^ ((mixed >> 13 ^ mixed) & mask)
+        return left << half_bits | right
+
+    def next_id(self):
+        value = self.permute(self.counter)
+        self.counter += 1
+        return f"{value:0{self.length}x}"
+
+    def allocate(self, text=None):
+        if self.seed is None:
+            return self.next_id()
+        if text is None:
+            new_id = self.next_id()
+            while new_id in self.issued:
+                new_id = self.next_id()
+        else:
+            salt = 0
+            while True:
+                digest = hashlib.blake2b(f"{self.seed}\0{salt}\0{text}".encode('utf-8'),
+                                         digest_size=(self.length + 1) // 2).hexdigest()
+                new_id = digest[:self.length]
+                if new_id not in self.issued:
+                    break
+                salt += 1
+        self.issued[new_id] = text
+        return new_id
+
+    def allocate_many(self, count):
+        if self.seed is not None:
+            return [self.allocate() for _ in range(count)]
+        start = self.counter
+        self.counter += count
+        length = self.length
+        permute = self.permute
+        return [f"{permute(value):0{length}x}" for value in range(start, start + count)]
+
+
+id_allocator = IdAllocator()
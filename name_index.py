@@ -0,0 +1,141 @@
+import re
+import unicodedata
+
+
+def normalize_name(name):
+    text = unicodedata.normalize("NFKC", str(name)).lower()
+    words = re.findall(r"[^\W_]+", text)
+    # crude plural folding, enough for "trees"/"tree" and "models"/"model"
+    words = [word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word for word in words]
+    return " ".join(words)
+
+def within_one_edit(text_1, text_2):
+    if abs(len(text_1) - len(text_2)) > 1:
+        return False
+    if len(text_1) < len(text_2):
+        text_1, text_2 = text_2, text_1
+    idx = 0
+    while idx < len(text_2) and text_1[idx] == text_2[idx]:
+        idx += 1
+    if len(text_1) == len(text_2):
+        return text_1[idx + 1:] == text_2[idx + 1:]
+    return text_1[idx + 1:] == text_2[idx:]
+
+def digit_runs(key):
+    return re.findall(r"\d+", key)
+
+def single_deletions(key):
+    return {key[:idx] + key[idx + 1:] for idx in range(len(key))} | {key}
+
+
+class NameTrie:
+    def __init__(self):
+        self.root = {}
+
+    def add(self, key):
+        node = self.root
+        for char in key:
+            node = node.setdefault(char, {})
+        node[None] = key
+
+    def search(self, key, max_distance):
+        # walks the trie with one edit-distance row per node and prunes branches that are already too far
+        matches = []
+        first_row = list(range(len(key) + 1))
+        stack = [(child, char, first_row) for char, child in self.root.items() if char is not None]
+        while stack:
+            node, char, previous_row = stack.pop()
+            row = [previous_row[0] + 1]
+            for col in range(1, len(key) + 1):
+                row.append(min(row[col - 1] + 1, previous_row[col] + 1, previous_row[col - 1] + (key[col - 1] != char)))
+            if row[-1] <= max_distance and None in node:
+                matches.append((row[-1], node[None]))
+            if min(row) <= max_distance:
+                for next_char, child in node.items():
+                    if next_char is not None:
+                        stack.append((child, next_char, row))
+        return matches
+
+
+class NameIndex:
+    def __init__(self, names):
+        self.names = set(names)
+        self.normalized = {}
+        self.ambiguous = set()
+        for name in self.names:
+            key = normalize_name(name)
+            if key in self.normalized and self.normalized[key] != name:
+                self.ambiguous.add(key)
+                continue
+            self.normalized[key] = name
+        # the fuzzy structures are only built once a name misses both hash lookups
+        self.deletions = None
+        self.trie = None
+        self.cache = {}
+        self.stats = {"exact": 0, "normalized": 0, "fuzzy": 0, "unresolved": 0}
+        self.unresolved = set()
+
+    def build_fuzzy(self):
+        self.deletions = {}
+        self.trie = NameTrie()
+        for key in self.normalized:
+            self.trie.add(key)
+            for deletion in single_deletions(key):
+                self.deletions.setdefault(deletion, []).append(key)
+
+    @staticmethod
+    def max_distance(key):
+        return min(2, len(key) // 5)
+
+    @staticmethod
+    def best_match(matches):
+        # a tie between two different items is too ambiguous to snap
+        matches = sorted(set(matches))
+        if not matches or (len(matches) > 1 and matches[0][0] == matches[1][0]):
+            return None
+        return matches[0]
+
+    def lookup(self, name):
+        if name in self.names:
+            return name, "exact"
+        key = normalize_name(name)
+        if key in self.normalized and key not in self.ambiguous:
+            return self.normalized[key], "normalized"
+        max_distance = self.max_distance(key)
+        if max_distance == 0:
+            return None, "unresolved"
+        if self.deletions is None:
+            self.build_fuzzy()
+        # a different number is a different item (GPT-3 and GPT-4, item10 and item100), never a typo
+        digits = digit_runs(key)
+        # one deletion on each side finds most single typos through hash lookups alone
+        candidates = {candidate for deletion in single_deletions(key) for candidate in self.deletions.get(deletion, ())}
+        near = [candidate for candidate in candidates if within_one_edit(key, candidate) and digit_runs(candidate) == digits]
+        if near:
+            match = self.best_match([(1, candidate) for candidate in near])
+        else:
+            match = self.best_match([(distance, candidate) for distance, candidate in self.trie.search(key, max_distance)
+                                     if digit_runs(candidate) == digits])
+        if match is None or match[0] > max_distance or match[1] in self.ambiguous:
+            return None, "unresolved"
+        return self.normalized[match[1]], "fuzzy"
+
+    def resolve(self, name):
+        if not isinstance(name, str):
+            return None
+        if name not in self.cache:
+            self.cache[name] = self.lookup(name)
+        canonical, kind = self.cache[name]
+        self.stats[kind] += 1
+        if canonical is None:
+            self.unresolved.add(name)
+        return canonical
+
+    def report(self, label):
+        stats = self.stats
+        text = (f"{label}: {stats['exact']} exact, {stats['normalized']} normalized, {stats['fuzzy']} fuzzy, "
+                f"{stats['unresolved']} unresolved names")
+        if self.unresolved:
+            unresolved = sorted(self.unresolved)
+            text += f" ({', '.join(unresolved[:10])}{', ...' if len(unresolved) > 10 else ''})"
+        return text
@@ -0,0 +1,102 @@
+import os
+import sys
+import json
+from generate_dependence import (pop_option, parse_args, run_dependence, dependence_file_name, fusion_file_name,
+                                 stream_sink_path_list, manifest_path, pop_prompt_options)
+from util import JobManifest, call_metrics
+from generate_tree import generate_trees
+from graph_normalize import spanning_strategies
+from id_allocator import id_allocator
+from generate_gitmind import write_single_gitmind, write_merged_gitmind, pop_export_options
+
+
+def run_pipeline(data_list, name_list, key_list_list, mix_key_list_list=None, chunk_size=100, min_score=None,
+                 output_dir="./data", save_intermediates=False, stream=False, resume=False, strategy="shallowest",
+                 reduce=False, seed=None):
+    # checked before the LLM stage, which is the expensive part to redo
+    if strategy not in spanning_strategies:
+        raise Exception(f"unknown spanning strategy {strategy}")
+    os.makedirs(output_dir, exist_ok=True)
+    id_allocator.reset(seed)
+
+    sink_path_list = stream_sink_path_list(name_list, output_dir, reset=not resume) if stream else None
+    manifest = JobManifest(manifest_path(name_list, output_dir), resume)
+    result_list, result_fusion = run_dependence(data_list, key_list_list, mix_key_list_list, chunk_size, min_score,
+                                                sink_path_list, manifest)
+    dependence_list = result_list if result_fusion is None else result_list + [result_fusion]
+    dependence_name_list = [dependence_file_name(name) for name in name_list]
+    if result_fusion is not None:
+        dependence_name_list.append(fusion_file_name(name_list))
+
+    root_name_list = [name.split("_")[0] for name in dependence_name_list]
+    tree_list, fusion_edges = generate_trees(dependence_list, root_name_list, strategy, reduce)
+
+    if save_intermediates:
+        for name, result in zip(dependence_name_list, dependence_list):
+            with open(os.path.join(output_dir, name), 'w', encoding='utf-8') as f:
+                json.dump(result, f, ensure_ascii=False, indent=4)
+        tree_result_list = tree_list if fusion_edges is None else tree_list + [fusion_edges]
+        for name, result in zip(dependence_name_list, tree_result_list):
+            with open(os.path.join(output_dir, name.replace("dependence", "tree")), 'w', encoding='utf-8') as f:
+                json.dump(result, f, indent=4)
+
+    output_path_list = []
+    for name, tree in zip(dependence_name_list, tree_list):
+        output_path = os.path.join(output_dir, name.replace("_dependence.json", ".gmind"))
+        output_path_list.extend(write_single_gitmind(output_path, tree))
+
+    if fusion_edges is not None:
+        output_path = os.path.join(output_dir, dependence_name_list[-1].replace("_dependence.json", ".gmind"))
+        output_path_list.extend(write_merged_gitmind(output_path, tree_list[0], tree_list[1], fusion_edges))
+
+    return {
+        "dependence": dependence_list,
+        "tree": tree_list,
+        "fusion": fusion_edges,
+        "output": output_path_list
+    }
+
+
+def main():
+    chunk_size = int(pop_option(sys.argv, "--chunk-size", 100))
+    pop_prompt_options(sys.argv)
+    pop_export_options(sys.argv)
+    min_score = pop_option(sys.argv, "--prune-score")
+    min_score = float(min_score) if min_score is not None else None
+    output_dir = pop_option(sys.argv, "--output-dir", "./data")
+    strategy = pop_option(sys.argv, "--strategy", "shallowest")
+    if strategy not in spanning_strategies:
+        print(f"error: unknown spanning strategy {strategy}, choose from {', '.join(spanning_strategies)}")
+        return
+    seed = pop_option(sys.argv, "--seed")
+    reduce = "--reduce" in sys.argv
+    if reduce:
+        sys.argv.remove("--reduce")
+    save_intermediates = "--save-intermediates" in sys.argv
+    if save_intermediates:
+        sys.argv.remove("--save-intermediates")
+    stream = "--stream" in sys.argv
+    if stream:
+        sys.argv.remove("--stream")
+    resume = "--resume" in sys.argv
+    if resume:
+        sys.argv.remove("--resume")
+    args = parse_args(sys.argv)
+    if args is None:
+        return
+    json_path_list, key_list_list, mix_key_list_list = args
+
+    data_list = []
+    for file_path in json_path_list:
+        with open(file_path, encoding='utf-8') as f:
+            data_list.append(json.load(f))
+
+    result = run_pipeline(data_list, json_path_list, key_list_list, mix_key_list_list, chunk_size, min_score,
+                          output_dir, save_intermediates, stream, resume, strategy, reduce, seed)
+    for output_path in result["output"]:
+        print(f"saved {output_path}")
+    print(call_metrics.format_summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+def iter_tree(tree, level=1):
+    if len(tree) == 0:
+        return
+    stack = [(tree, level, None)]
+    while stack:
+        node, node_level, parent = stack.pop()
+        yield node, node_level, parent
+        children = node.get('children', [])
+        for idx in range(len(children) - 1, -1, -1):
+            stack.append((children[idx], node_level + 1, node))
@@ -1,61 +1,744 @@
-from openai import OpenAI
 import threading
+import asyncio
+import hashlib
+import sqlite3
+import random
+import time
 import os
 import re
 import json
+import glob
+import tempfile
+import weakref
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from types import SimpleNamespace
 
-config_list = [
-    {"api_key": os.environ["DEEPSEEK_API_KEY"], "base_url": "https://api.deepseek.com", "model": "deepseek-chat"},
-    {"api_key": os.environ['BAILIAN_API_KEY'], "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1", "model": "deepseek-v3"}
+default_config_list = [
+    {"api_key_env": "DEEPSEEK_API_KEY", "base_url": "https://api.deepseek.com", "model": "deepseek-chat"},
+    {"api_key_env": "BAILIAN_API_KEY", "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1", "model": "deepseek-v3"}
 ]
 
+def load_config_list(path=None):
+    path = path or os.environ.get("CONVERTOMIND_CONFIG")
+    if path:
+        with open(path, encoding='utf-8') as f:
+            entries = json.load(f)
+    else:
+        entries = default_config_list
+    config_list = []
+    for entry in entries:
+        config = dict(entry)
+        api_key_env = config.pop("api_key_env", None)
+        if "api_key" not in config:
+            if api_key_env is None or api_key_env not in os.environ:
+                continue
+            config["api_key"] = os.environ[api_key_env]
+        config_list.append(config)
+    return config_list
+
+@lru_cache(maxsize=None)
+def get_retryable_errors():
+    from openai import RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+    return (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+def load_completion(value):
+    return json.loads(value, object_hook=lambda d: SimpleNamespace(**d))
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=3, cooldown=30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def available(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            return time.monotonic() - self.opened_at >= self.cooldown
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+def backoff_delay(attempt, base=1.0, max_delay=60.0):
+    return random.uniform(0, min(max_delay, base * 2 ** attempt))
+
+class ResponseCache:
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, bypass=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            dir_name = os.path.dirname(self.path)
+            if dir_name:
+                os.makedirs(dir_name, exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            self.conn.commit()
+        return self.conn
+
+    @staticmethod
+    def make_key(model, messages, temperature):
+        payload = json.dumps([model, messages, temperature], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if self.bypass:
+            return None
+        with self.lock:
+            conn = self.connect()
+            row = conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+            return row[0]
+
+    def set(self, key, value):
+        if self.bypass:
+            return
+        with self.lock:
+            conn = self.connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8")), time.time())
+            )
+            self.evict(conn)
+            conn.commit()
+
+    def evict(self, conn):
+        total_size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+            if total_size <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total_size -= size
+
+    def clear(self):
+        with self.lock:
+            conn = self.connect()
+            conn.execute("DELETE FROM responses")
+            conn.commit()
+
+response_cache = ResponseCache(
+    os.environ.get("CONVERTOMIND_CACHE_PATH", "./data/llm_cache.sqlite"),
+    max_bytes=int(os.environ.get("CONVERTOMIND_CACHE_MAX_BYTES", 512 * 1024 * 1024)),
+    bypass=os.environ.get("CONVERTOMIND_NO_CACHE", "") not in ("", "0")
+)
+
+class JobManifest:
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.tasks = {}
+        if resume and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except Exception:
+                        continue
+                    self.tasks[entry['task_id']] = entry
+        else:
+            with open(path, 'w', encoding='utf-8'):
+                pass
+
+    @staticmethod
+    def make_task_id(*payload):
+        return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, task_id):
+        with self.lock:
+            return self.tasks.get(task_id)
+
+    def record(self, task_id, status, result=None, **info):
+        entry = {"task_id": task_id, "status": status, "time": time.time(), **info}
+        if result is not None:
+            entry["result"] = result
+        with self.lock:
+            self.tasks[task_id] = entry
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def summary(self):
+        with self.lock:
+            counts = {}
+            for entry in self.tasks.values():
+                counts[entry['status']] = counts.get(entry['status'], 0) + 1
+            return counts
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class CallMetrics:
+    def __init__(self, trace_path=None):
+        self.trace_path = trace_path
+        self.lock = threading.Lock()
+        self.calls = []
+        self.repairs = {"local": 0, "llm": 0, "failed": 0}
+        if trace_path:
+            dir_name = os.path.dirname(trace_path)
+            if dir_name:
+                os.makedirs(dir_name, exist_ok=True)
+
+    def write_trace(self, entry):
+        if not self.trace_path:
+            return
+        with open(self.trace_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def record_call(self, api, latency, status="ok", usage=None, retries=0, cached=False, stream=False):
+        entry = {
+            "event": "call",
+            "time": time.time(),
+            "backend": api.base_url,
+            "model": api.model,
+            "status": status,
+            "latency": latency,
+            "prompt_tokens": getattr(usage, "prompt_tokens", None) or 0,
+            "completion_tokens": getattr(usage, "completion_tokens", None) or 0,
+            "retries": retries,
+            "cached": cached,
+            "stream": stream,
+            "cost": 0.0
+        }
+        entry["cost"] = (entry["prompt_tokens"] * api.prompt_price + entry["completion_tokens"] * api.completion_price) / 1e6
+        with self.lock:
+            self.calls.append(entry)
+            self.write_trace(entry)
+
+    def record_repair(self, kind):
+        with self.lock:
+            self.repairs[kind] += 1
+            self.write_trace({"event": "repair", "time": time.time(), "kind": kind})
+
+    def summary(self):
+        with self.lock:
+            calls = list(self.calls)
+            repairs = dict(self.repairs)
+        backends = {}
+        for entry in calls:
+            backends.setdefault((entry["model"], entry["backend"]), []).append(entry)
+        backend_list = []
+        for (model, backend), entries in backends.items():
+            served = [entry for entry in entries if entry["status"] == "ok" and not entry["cached"]]
+            latencies = [entry["latency"] for entry in served]
+            completion_tokens = sum(entry["completion_tokens"] for entry in served)
+            backend_list.append({
+                "model": model,
+                "backend": backend,
+                "calls": len(entries),
+                "cached": sum(1 for entry in entries if entry["cached"]),
+                "failed": sum(1 for entry in entries if entry["status"] != "ok"),
+                "p50_latency": percentile(latencies, 0.5),
+                "p95_latency": percentile(latencies, 0.95),
+                "prompt_tokens": sum(entry["prompt_tokens"] for entry in served),
+                "completion_tokens": completion_tokens,
+                "tokens_per_second": completion_tokens / sum(latencies) if sum(latencies) > 0 else 0.0,
+                "cost": sum(entry["cost"] for entry in served)
+            })
+        return {
+            "calls": len(calls),
+            "retries": sum(1 for entry in calls if entry["retries"] > 0),
+            "repairs": repairs,
+            "backends": backend_list
+        }
+
+    def format_summary(self):
+        summary = self.summary()
+        if summary["calls"] == 0 and not any(summary["repairs"].values()):
+            return "no LLM calls"
+        repairs = summary["repairs"]
+        lines = [f"LLM calls: {summary['calls']} ({summary['retries']} retries), "
+                 f"json repairs: {repairs['local']} local / {repairs['llm']} llm / {repairs['failed']} failed"]
+        for item in summary["backends"]:
+            line = (f"  {item['model']} @ {item['backend']}: {item['calls']} calls ({item['cached']} cached, "
+                    f"{item['failed']} failed), p50 {item['p50_latency']:.2f}s, p95 {item['p95_latency']:.2f}s, "
+                    f"{item['prompt_tokens']} prompt + {item['completion_tokens']} completion tokens, "
+                    f"{item['tokens_per_second']:.1f} tokens/s")
+            if item["cost"]:
+                line += f", cost {item['cost']:.4f}"
+            lines.append(line)
+        return "\n".join(lines)
+
+call_metrics = CallMetrics(os.environ.get("CONVERTOMIND_TRACE_PATH"))
+
 class APIWrapper:
-    def __init__(self, api_key, base_url, model):
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
+    def __init__(self, api_key, base_url, model, max_in_flight=1, rate=None, failure_threshold=3, cooldown=30.0,
+                 metrics=None, prompt_price=0.0, completion_price=0.0):
+        self.client = None
+        self.api_key = api_key
+        self.base_url = base_url
+        # asyncio objects are bound to the loop they were first used on, and gather() runs a new loop each time
+        self.async_clients = weakref.WeakKeyDictionary()
         self.model = model
-    
-    def create(self, *args, **kwargs):
-        print(f"you are using {self.model}")
+        self.metrics = metrics
+        # prices are per million tokens and only used for the cost column of the metrics
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.semaphores = weakref.WeakKeyDictionary()
+        self.rate_limiter = TokenBucket(rate) if rate else None
+        self.breaker = CircuitBreaker(failure_threshold, cooldown)
+
+    def get_client(self):
+        if self.client is None:
+            from openai import OpenAI
+            self.client = OpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0)
+        return self.client
+
+    def get_async_client(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self.async_clients:
+            from openai import AsyncOpenAI
+            self.async_clients[loop] = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0)
+        return self.async_clients[loop]
+
+    def get_semaphore(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self.semaphores:
+            self.semaphores[loop] = asyncio.Semaphore(self.max_in_flight)
+        return self.semaphores[loop]
+
+    def record(self, start, status="ok", usage=None, attempt=0, cached=False, stream=False):
+        if self.metrics is not None:
+            self.metrics.record_call(self, time.perf_counter() - start, status, usage, attempt, cached, stream)
+
+    def record_stream(self, completion, start, attempt):
+        usage = None
+        try:
+            for chunk in completion:
+                if getattr(chunk, "usage", None) is not None:
+                    usage = chunk.usage
+                yield chunk
+        except Exception as e:
+            self.record(start, type(e).__name__, usage, attempt, stream=True)
+            raise
+        self.record(start, "ok", usage, attempt, stream=True)
+
+    async def arecord_stream(self, completion, start, attempt):
+        usage = None
+        try:
+            async for chunk in completion:
+                if getattr(chunk, "usage", None) is not None:
+                    usage = chunk.usage
+                yield chunk
+        except Exception as e:
+            self.record(start, type(e).__name__, usage, attempt, stream=True)
+            raise
+        self.record(start, "ok", usage, attempt, stream=True)
+
+    def create(self, *args, attempt=0, **kwargs):
+        kwargs.pop('model', None)
+        if kwargs.get('stream'):
+            # OpenAI-compatible APIs only send token usage on streams that ask for it
+            kwargs.setdefault('stream_options', {"include_usage": True})
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        openai_client = self.get_client()
+        start = time.perf_counter()
+        try:
+            completion = openai_client.chat.completions.create(model=self.model, *args, **kwargs)
+        except Exception as e:
+            self.record(start, type(e).__name__, attempt=attempt, stream=bool(kwargs.get('stream')))
+            raise
+        if kwargs.get('stream'):
+            if self.metrics is None:
+                return completion
+            return self.record_stream(completion, start, attempt)
+        self.record(start, usage=completion.usage, attempt=attempt)
+        return completion
+
+    async def acreate(self, *args, attempt=0, **kwargs):
         kwargs.pop('model', None)
-        return self.client.chat.completions.create(model=self.model, *args, **kwargs)
+        if kwargs.get('stream'):
+            kwargs.setdefault('stream_options', {"include_usage": True})
+        async with self.get_semaphore():
+            if self.rate_limiter is not None:
+                await self.rate_limiter.aacquire()
+            openai_client = self.get_async_client()
+            start = time.perf_counter()
+            try:
+                completion = await openai_client.chat.completions.create(model=self.model, *args, **kwargs)
+            except Exception as e:
+                self.record(start, type(e).__name__, attempt=attempt, stream=bool(kwargs.get('stream')))
+                raise
+        if kwargs.get('stream'):
+            if self.metrics is None:
+                return completion
+            return self.arecord_stream(completion, start, attempt)
+        self.record(start, usage=completion.usage, attempt=attempt)
+        return completion
          
 
 class CompletionsWrapper:
-    def __init__(self, config_list):
+    def __init__(self, config_list, cache=None, workers_per_api=1, max_retries=5, metrics=None):
+        self.max_retries = max_retries
+        self.cache = cache
+        self.metrics = metrics
         self.client_list = [
-            APIWrapper(**config)
+            APIWrapper(**{"max_in_flight": workers_per_api, **config}, metrics=metrics)
             for config in config_list
         ]
         self.client_num = len(self.client_list)
+        # without backends only cached responses can be served, one at a time
+        self.max_in_flight = sum(api.max_in_flight for api in self.client_list) or 1
         self.visit_num = 0
         self.lock = threading.Lock()
-    
-    def create(self, *args, **kwargs):
+
+    def acquire_client(self):
+        if self.client_num == 0:
+            raise Exception("no LLM backend configured, set DEEPSEEK_API_KEY/BAILIAN_API_KEY or CONVERTOMIND_CONFIG")
         with self.lock:
-            current_client_index = self.visit_num % self.client_num
+            offset = self.visit_num % self.client_num
             self.visit_num += 1
-        return self.client_list[current_client_index].create(*args, **kwargs)
+            order = self.client_list[offset:] + self.client_list[:offset]
+            healthy = [api for api in order if api.breaker.available()]
+            api = min(healthy or order, key=lambda api: api.in_flight / api.max_in_flight)
+            api.in_flight += 1
+        return api
+
+    def release_client(self, api):
+        with self.lock:
+            api.in_flight -= 1
+
+    def cache_key(self, kwargs):
+        # keyed on the request rather than on the backend that happens to serve it, so any backend's answer is reused
+        if self.cache is None or self.cache.bypass or kwargs.get('stream'):
+            return None
+        return ResponseCache.make_key(kwargs.get('model'), kwargs.get('messages'), kwargs.get('temperature'))
+
+    def get_cached(self, key):
+        start = time.perf_counter()
+        cached = self.cache.get(key)
+        if cached is None:
+            return None
+        completion = load_completion(cached)
+        if self.metrics is not None:
+            source = SimpleNamespace(base_url="cache", model=getattr(completion, "model", None), prompt_price=0.0, completion_price=0.0)
+            self.metrics.record_call(source, time.perf_counter() - start, usage=getattr(completion, "usage", None), cached=True)
+        return completion
+
+    def create(self, *args, **kwargs):
+        key = self.cache_key(kwargs)
+        if key is not None:
+            completion = self.get_cached(key)
+            if completion is not None:
+                return completion
+        attempt = 0
+        while True:
+            api = self.acquire_client()
+            try:
+                completion = api.create(*args, attempt=attempt, **kwargs)
+                api.breaker.record_success()
+                if key is not None:
+                    self.cache.set(key, completion.model_dump_json())
+                return completion
+            except get_retryable_errors() as e:
+                api.breaker.record_failure()
+                if attempt >= self.max_retries:
+                    raise
+                print(f"{api.model} failed ({type(e).__name__}), retry {attempt + 1}/{self.max_retries}")
+            finally:
+                self.release_client(api)
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+
+    async def acreate(self, *args, **kwargs):
+        key = self.cache_key(kwargs)
+        if key is not None:
+            completion = self.get_cached(key)
+            if completion is not None:
+                return completion
+        attempt = 0
+        while True:
+            api = self.acquire_client()
+            try:
+                completion = await api.acreate(*args, attempt=attempt, **kwargs)
+                api.breaker.record_success()
+                if key is not None:
+                    self.cache.set(key, completion.model_dump_json())
+                return completion
+            except get_retryable_errors() as e:
+                api.breaker.record_failure()
+                if attempt >= self.max_retries:
+                    raise
+                print(f"{api.model} failed ({type(e).__name__}), retry {attempt + 1}/{self.max_retries}")
+            finally:
+                self.release_client(api)
+            await asyncio.sleep(backoff_delay(attempt))
+            attempt += 1
+
+    async def agather(self, kwargs_list, return_exceptions=False):
+        return await asyncio.gather(
+            *[self.acreate(**kwargs) for kwargs in kwargs_list],
+            return_exceptions=return_exceptions
+        )
+
+    def gather(self, kwargs_list, return_exceptions=False):
+        return asyncio.run(self.agather(kwargs_list, return_exceptions))
 
 class ChatWrapper:
-    def __init__(self, config_list):
-        self.completions = CompletionsWrapper(config_list)
+    def __init__(self, config_list, cache=None, workers_per_api=1, metrics=None):
+        self.completions = CompletionsWrapper(config_list, cache, workers_per_api, metrics=metrics)
         self.client_num = self.completions.client_num
 
 class ClientWrapper:
-    def __init__(self, config_list, workers_per_api=1):
-        self.chat = ChatWrapper(config_list)
-        self.max_workers = self.chat.client_num * workers_per_api
+    def __init__(self, config_list=None, workers_per_api=1, cache=None, metrics=None):
+        self.config_list = config_list
+        self.workers_per_api = workers_per_api
+        self.cache = cache
+        self.metrics = metrics
+        self._chat = None
+        self.lock = threading.Lock()
+
+    @property
+    def chat(self):
+        if self._chat is None:
+            with self.lock:
+                if self._chat is None:
+                    config_list = self.config_list if self.config_list is not None else load_config_list()
+                    self._chat = ChatWrapper(config_list, self.cache, self.workers_per_api, self.metrics)
+        return self._chat
+
+    @property
+    def max_workers(self):
+        return self.chat.completions.max_in_flight
+
+client = ClientWrapper(
+    workers_per_api=int(os.environ.get("CONVERTOMIND_WORKERS_PER_API", 4)),
+    cache=response_cache,
+    metrics=call_metrics
+)
+
+def pop_option(argv, name, default=None):
+    for idx, arg in enumerate(argv):
+        if arg == name and idx + 1 < len(argv):
+            value = argv[idx+1]
+            del argv[idx:idx+2]
+            return value
+        if arg.startswith(name + "="):
+            del argv[idx]
+            return arg[len(name)+1:]
+    return default
 
-client = ClientWrapper(config_list)
+def is_batch_args(arg_list):
+    return any(os.path.isdir(arg) or any(char in arg for char in "*?[") for arg in arg_list)
+
+def expand_input_paths(arg_list, suffixes):
+    # directories are searched (not recursively) for files ending in one of suffixes, other arguments are globs
+    path_list = []
+    for arg in arg_list:
+        if os.path.isdir(arg):
+            matches = [os.path.join(arg, name) for name in os.listdir(arg)]
+        else:
+            matches = glob.glob(arg)
+        path_list.extend(sorted(path for path in matches if path.endswith(suffixes) and os.path.isfile(path)))
+    return list(dict.fromkeys(path_list))
+
+def is_up_to_date(input_path, output_path_list):
+    input_mtime = os.path.getmtime(input_path)
+    return all(os.path.exists(path) and os.path.getmtime(path) > input_mtime for path in output_path_list)
+
+def atomic_write(path, write):
+    dir_name = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix=".", suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def run_batch(func, task_list, max_workers=None):
+    # task_list holds argument tuples for func, which has to be a module-level function so it can be pickled
+    if len(task_list) == 0:
+        return 0
+    max_workers = min(max_workers or os.cpu_count() or 1, len(task_list))
+    failed_num = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(func, *task): task for task in task_list}
+        for future in as_completed(futures):
+            try:
+                print(f"saved {', '.join(future.result())}")
+            except Exception as e:
+                failed_num += 1
+                print(f"error: {futures[future][0]} failed: {e}")
+    return failed_num
 
 def extract_from_code_block(text):
     matches = re.findall(r'```(.*?)```', text, re.DOTALL)
     if matches:
         return [match.strip() for match in matches]
+    elif "```" in text:
+        print("Unterminated code block found")
+        return [text.split("```", 1)[1].strip()]
     else:
         print("No code blocks found")
         return []
 
+json_literals = {"true": "true", "false": "false", "null": "null", "True": "true", "False": "false", "None": "null"}
+
+def read_json_string(text, idx):
+    quote = text[idx]
+    chars = []
+    idx += 1
+    while idx < len(text):
+        char = text[idx]
+        if char == "\\" and idx + 1 < len(text):
+            next_char = text[idx+1]
+            chars.append(next_char if next_char == "'" else char + next_char)
+            idx += 2
+            continue
+        if char == quote:
+            return '"' + "".join(chars) + '"', idx + 1, True
+        if char == '"':
+            chars.append('\\"')
+        elif char == "\n":
+            chars.append("\\n")
+        else:
+            chars.append(char)
+        idx += 1
+    return '"' + "".join(chars) + '"', idx, False
+
+def repair_json(text):
+    text = re.sub(r"^\s*```[a-zA-Z]*", "", text)
+    text = re.sub(r"```\s*$", "", text)
+    start_idx = min([idx for idx in (text.find("["), text.find("{")) if idx != -1], default=-1)
+    if start_idx == -1:
+        return text
+    text = text[start_idx:]
+
+    out = []
+    stack = []
+    expect_key = []
+    safe_point = (0, [])
+    idx = 0
+    while idx < len(text) and (stack or not out):
+        char = text[idx]
+        if char.isspace():
+            idx += 1
+        elif text.startswith("//", idx):
+            end_idx = text.find("\n", idx)
+            idx = len(text) if end_idx == -1 else end_idx
+        elif text.startswith("/*", idx):
+            end_idx = text.find("*/", idx + 2)
+            idx = len(text) if end_idx == -1 else end_idx + 2
+        elif char in "[{":
+            out.append(char)
+            stack.append("]" if char == "[" else "}")
+            expect_key.append(char == "{")
+            idx += 1
+        elif char in "]}":
+            if out and out[-1] == ",":
+                out.pop()
+            if stack:
+                out.append(stack.pop())
+                expect_key.pop()
+                safe_point = (len(out), list(stack))
+            idx += 1
+        elif char == ",":
+            if out and out[-1] not in "[{,":
+                out.append(",")
+            if expect_key and stack[-1] == "}":
+                expect_key[-1] = True
+            idx += 1
+        elif char == ":":
+            out.append(":")
+            if expect_key:
+                expect_key[-1] = False
+            idx += 1
+        elif char in "\"'":
+            string, idx, closed = read_json_string(text, idx)
+            if not closed:
+                break
+            out.append(string)
+            if not (stack and stack[-1] == "}" and expect_key[-1]):
+                safe_point = (len(out), list(stack))
+        else:
+            match = re.match(r"[^\s,:\[\]{}\"']+", text[idx:])
+            token = match.group(0)
+            idx += len(token)
+            if stack and stack[-1] == "}" and expect_key[-1]:
+                out.append(json.dumps(token))
+                continue
+            if token in json_literals:
+                out.append(json_literals[token])
+            elif re.fullmatch(r"-?\d+(\.\d+)?([eE][+-]?\d+)?", token):
+                out.append(token)
+            else:
+                out.append(json.dumps(token))
+            if idx < len(text):
+                safe_point = (len(out), list(stack))
+
+    if stack:
+        out_len, stack = safe_point
+        out = out[:out_len]
+        while out and out[-1] in ",:":
+            out.pop()
+        out.extend(reversed(stack))
+    return "".join(out)
+
 
 reformat_json_prompt = '''Please convert invalid input json to valid json.
 The output should be presented within a code block in the following format: "json\n<output>", where "<output>" is the placeholder for the output.
@@ -89,8 +772,17 @@ def reformat_json_multi_round(text, num_round=3):
 def extract_json_from_str(str):
     result_str = str.strip("json\n").strip("<").strip(">")
     try:
-        result_json = json.loads(result_str)
+        return json.loads(result_str)
     except Exception as e:
         print(f"Exception: {e}")
-        result_json = reformat_json_multi_round(result_str)
+    try:
+        result_json = json.loads(repair_json(result_str))
+        call_metrics.record_repair("local")
+        return result_json
+    except Exception as e:
+        print(f"local repair failed: {e}")
+    call_metrics.record_repair("llm")
+    result_json = reformat_json_multi_round(result_str)
+    if result_json is None:
+        call_metrics.record_repair("failed")
     return result_json
\ No newline at end of file